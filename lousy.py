@@ -27,7 +27,6 @@ import select
 import re
 import collections
 import copy
-import asyncore
 import threading
 import socket
 import struct
@@ -36,10 +35,26 @@ import traceback
 import math
 import termios
 import pprint
+import signal
+import pickle
+import _multiprocessing
+import functools
+import itertools
+import tempfile
+import mmap
+import resource
+import ctypes
+import Queue
 
 DEFAULT_PORT = 12345
 MSG_HEADER_FMT = '!L'
 
+# Environment variables telling a process started by Process(stub=...) how to
+# reach StubCentral
+STUB_PATH_ENV = 'LOUSY_STUB_PATH'
+STUB_PORT_ENV = 'LOUSY_STUB_PORT'
+STUB_FD_ENV = 'LOUSY_STUB_FD'
+
 # A hack to allow us to pass the debug setting from lousy as a script to lousy as a library
 try:
 	_debug = unittest._lousy_debug
@@ -51,6 +66,11 @@ try:
 except:
 	stubs = None
 
+try:
+	launcher = unittest._lousy_launcher
+except:
+	launcher = None
+
 class FrameBufferCell(object):
 	'''Class which tracks the value and attributes of a character cell in the
 	   framebuffer.
@@ -98,8 +118,16 @@ class DumbTerminal(object):
 	def __init__(self):
 		self.initialSettings()
 
+		# Each terminal needs its own handlers bound to itself
+		self.modes = {}
+
 		self.framebuffer = [[FrameBufferCell() for col in range(self.cols)] for row in range(self.rows)]
 
+		# Rows are stamped with the value of the change counter whenever they
+		# may have been modified so the screen can be rechecked selectively
+		self.changes = 0
+		self.rowChanges = [0] * self.rows
+
 		self.modes['normal'] = {
 				'default': self.i_normal_chars,
 				chr(0x00): self.i_ignore,
@@ -240,9 +268,18 @@ class DumbTerminal(object):
 
 		return self.framebuffer[row][col]
 
+	def touchRows(self, top, bottom):
+		'''Mark the rows from top to bottom inclusive as changed'''
+		self.changes += 1
+		for row in range(max(top, 0), min(bottom, self.rows - 1) + 1):
+			self.rowChanges[row] = self.changes
+
 	def interpret(self, c):
 		'''Take the given character and interpret it'''
 		cell = self.cell(self.current_row, self.current_col)
+		if 0 <= self.current_row < self.rows:
+			self.changes += 1
+			self.rowChanges[self.current_row] = self.changes
 
 		if c in self.modes[self.mode]:
 			self.modes[self.mode][c](cell, c)
@@ -260,6 +297,7 @@ class DumbTerminal(object):
 			if self.autoscroll:
 				del self.framebuffer[self.margin_top]
 				self.framebuffer.insert(self.margin_bottom, [FrameBufferCell() for col in range(self.cols)])
+				self.touchRows(self.margin_top, self.margin_bottom)
 			self.current_row -= 1
 
 	def i_ignore(self, cell, c):
@@ -376,6 +414,7 @@ class VT05(DumbTerminal):
 
 	def i_normal_eraseScreen(self, cell, c):
 		self.eraseToEndOfLine()
+		self.touchRows(self.current_row, self.rows - 1)
 		for row in range(self.current_row + 1, self.rows):
 			for col in range(self.cols):
 				cell = self.cell(row, col)
@@ -576,6 +615,7 @@ class VT100(DumbTerminal):
 			# Scroll down one line
 			del self.framebuffer[self.margin_bottom]
 			self.framebuffer.insert(self.margin_top, [FrameBufferCell() for col in range(self.cols)])
+			self.touchRows(self.margin_top, self.margin_bottom)
 			self.current_row += 1
 
 		self.mode = 'normal'
@@ -598,6 +638,7 @@ class VT100(DumbTerminal):
 		self.mode = 'normal'
 
 	def i_private_EFill(self, cell, c):
+		self.touchRows(0, self.rows - 1)
 		for row in range(self.rows):
 			for col in range(self.cols):
 				cell = self.cell(row, col)
@@ -607,6 +648,7 @@ class VT100(DumbTerminal):
 		self.csi_params += c
 
 	def i_csi_clearScreen(self, cell, c):
+		self.touchRows(0, self.rows - 1)
 		if self.csi_params == '0' or len(self.csi_params) == 0:
 			# Clear from the cursor to the end of the screen
 			for col in range(self.current_col, self.cols):
@@ -906,7 +948,7 @@ class Vtty(object):
 	   virtual framebuffer which can be examined to confirm process output.
 	'''
 
-	emulation = None
+	_emulation = None
 
 	supported = {
 			'dumb': DumbTerminal,
@@ -916,28 +958,105 @@ class Vtty(object):
 			}
 
 
-	def __init__(self, emulation='vt100'):
+	modes = ('immediate', 'lazy', 'thread')
+
+	def __init__(self, emulation='vt100', mode='immediate', queueSize=64):
 		'''emulation is the terminal emulator featureset and control codes to emulate.
 		   Valid values are:
 		   dumb
 		   vt05
 		   vt100
 		   typical - supports all the common set of escape codes
+
+		   mode is when the output is interpreted. Valid values are:
+		   immediate - as soon as it is appended
+		   lazy      - only once the screen is next examined, all at once
+		   thread    - by a worker thread so that appending never waits for the
+		               interpretation. Examining the screen waits until all the
+		               output appended so far has been interpreted.
+
+		   queueSize is the number of chunks of output which may be waiting for the
+		   worker thread before append() blocks.
 		'''
 		if emulation is True:
 			emulation = 'vt100'
 
 		if emulation in self.supported:
-			self.emulation = self.supported[emulation]()
+			self._emulation = self.supported[emulation]()
 		else:
 			raise ValueError('%s is not a supported terminal emulation type' % emulation)
 
+		if mode not in self.modes:
+			raise ValueError('%s is not a supported Vtty mode' % mode)
+		self.mode = mode
+		self._journal = []
+		self._queue = None
+		self._error = None
+
+		if mode == 'thread':
+			self._queue = Queue.Queue(queueSize)
+			self._worker = threading.Thread(target=self._interpretQueued, name='Vtty')
+			self._worker.daemon = True
+			self._worker.start()
+
+	@property
+	def emulation(self):
+		'''The emulated terminal, brought up to date with all the output appended so far'''
+		self.sync()
+		return self._emulation
+
+	def sync(self):
+		'''Wait until all the output appended so far has been interpreted'''
+		if self._journal:
+			self._interpret(''.join(self._journal))
+			self._journal = []
+
+		if self._queue is not None:
+			self._queue.join()
+
+		if self._error is not None:
+			error, self._error = self._error, None
+			raise error
+
+	def close(self):
+		'''Stop the worker thread, if any, once it has interpreted the output
+		   queued for it. Output appended afterwards is interpreted immediately.
+		   In lazy mode the output is still only interpreted once the screen
+		   is examined.
+		'''
+		if self._queue is not None:
+			self._queue.put(None)
+			self._worker.join()
+			self._queue = None
+
+	def _interpretQueued(self):
+		while True:
+			input = self._queue.get()
+			try:
+				if input is None:
+					return
+				self._interpret(input)
+			except Exception as e:
+				self._error = e
+			finally:
+				self._queue.task_done()
+
+	def _interpret(self, input):
+		interpret = self._emulation.interpret
+		for c in input:
+			interpret(c)
+
 	def append(self, input):
 		'''Interpret the given stream of bytes to make their modification to the current
-		   state of the virtual terminal.
+		   state of the virtual terminal. In lazy mode the bytes are only recorded
+		   until the screen is next examined.
 		'''
-		for c in input:
-			self.emulation.interpret(c)
+		if self._queue is not None:
+			self._queue.put(input)
+		elif self.mode == 'lazy':
+			self._journal.append(input)
+		else:
+			self._interpret(input)
 
 	def cell(self, row, col):
 		return self.emulation.cell(row, col)
@@ -955,6 +1074,29 @@ class Vtty(object):
 				s += cell.char
 		return s
 
+	def row(self, row, left=0, right=None):
+		'''Return the text of the row from column left to right inclusive, by
+		   default the whole row. Blank cells are returned as spaces so that
+		   offsets into the string match the columns.
+		'''
+		if right is None:
+			right = self.emulation.cols - 1
+		s = ''
+		for cell in self.emulation.framebuffer[row][left:right + 1]:
+			if cell.char == '' or cell.char == '\t':
+				s += ' '
+			else:
+				s += cell.char
+		return s
+
+	def changes(self):
+		'''Returns a counter which increases whenever the screen may have changed'''
+		return self.emulation.changes
+
+	def rowChanged(self, row, since):
+		'''Returns True if the row may have changed after changes() returned since'''
+		return self.emulation.rowChanges[row] > since
+
 	def cursorPosition(self):
 		'''Return the 2-tuple with the current cursor position'''
 		return (self.emulation.current_row, self.emulation.current_col)
@@ -992,6 +1134,186 @@ def _escapeAscii(string):
 	string = ''.join(map(escape_whitespace, string))
 	return string.encode('unicode_escape')
 
+class RegexCache(object):
+	'''Cache of compiled regexes with least recently used eviction.
+
+	   re keeps only a small cache of its own which is cleared entirely once it
+	   fills, so a suite using many different patterns would recompile them over
+	   and over. Patterns which are already compiled are returned unchanged.
+	'''
+
+	def __init__(self, size=512):
+		self.size = size
+		self.hits = 0
+		self.misses = 0
+		self._patterns = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def resize(self, size):
+		with self._lock:
+			self.size = size
+			self._evict()
+
+	def _evict(self):
+		while len(self._patterns) > self.size:
+			self._patterns.popitem(last=False)
+
+	def compile(self, regex):
+		'''Returns the compiled form of the regex'''
+		if not isinstance(regex, basestring):
+			return regex
+
+		with self._lock:
+			compiled = self._patterns.pop(regex, None)
+			if compiled is None:
+				self.misses += 1
+				compiled = re.compile(regex)
+			else:
+				self.hits += 1
+			self._patterns[regex] = compiled
+			self._evict()
+		return compiled
+
+	def hitRate(self):
+		lookups = self.hits + self.misses
+		if lookups == 0:
+			return 0.0
+		return float(self.hits) / lookups
+
+	def __str__(self):
+		return 'regex cache: %d hits %d misses (%.1f%% hit rate) %d/%d patterns' % (self.hits,
+				self.misses, self.hitRate() * 100, len(self._patterns), self.size)
+
+try:
+	regexCache = unittest._lousy_regex_cache
+except:
+	regexCache = RegexCache()
+
+def _select(readers, writers, timeout):
+	'''select.select() which treats being interrupted by a signal as a wakeup
+	   with nothing ready rather than an error.
+	'''
+	try:
+		return select.select(readers, writers, [], timeout)
+	except select.error as e:
+		if e.args[0] == errno.EINTR:
+			return [], [], []
+		raise
+
+class _ChildWatcher(object):
+	'''Turns SIGCHLD into a readable file descriptor, using the self-pipe trick,
+	   so the exit of a child can be waited for in the same select() as its
+	   output. Signals can only be hooked from the main thread, in other threads
+	   fileno() returns None and the caller must fall back to polling. The same
+	   happens if something else already owns the signal wakeup fd, which is
+	   left in place and not asked for again.
+	'''
+
+	def __init__(self):
+		self._pipe = None
+		self._previous = None
+		self._unavailable = False # The wakeup fd belongs to someone else
+
+	def fileno(self):
+		if self._pipe is None:
+			if self._unavailable or \
+					not isinstance(threading.current_thread(), threading._MainThread):
+				return None
+
+			r, w = os.pipe()
+			for fd in (r, w):
+				flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+				fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+				flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+				fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+			try:
+				# There is only one wakeup fd, so only take it if it is unused
+				previous = signal.set_wakeup_fd(w)
+				if previous != -1:
+					signal.set_wakeup_fd(previous)
+					os.close(r)
+					os.close(w)
+					self._unavailable = True
+					return None
+				self._previous = signal.signal(signal.SIGCHLD, self._handler)
+			except ValueError:
+				# Not the main thread
+				os.close(r)
+				os.close(w)
+				return None
+
+			# The wakeup fd is written by the C level handler, so a select()
+			# in the main thread wakes even if the signal was delivered to
+			# another thread.
+			signal.siginterrupt(signal.SIGCHLD, False)
+			self._pipe = (r, w)
+
+		return self._pipe[0]
+
+	def _handler(self, signum, frame):
+		if callable(self._previous):
+			self._previous(signum, frame)
+
+	def clear(self):
+		'''Discard any pending notifications'''
+		try:
+			while len(os.read(self._pipe[0], 1024)) > 0:
+				pass
+		except OSError as e:
+			if e.errno != errno.EAGAIN:
+				raise
+
+	def close(self):
+		'''Give back the signal wakeup fd and SIGCHLD handler. Must be called
+		   from the main thread.
+		'''
+		self._unavailable = False
+		if self._pipe is None:
+			return
+
+		signal.set_wakeup_fd(-1)
+		previous = self._previous
+		if previous is None:
+			previous = signal.SIG_DFL
+		signal.signal(signal.SIGCHLD, previous)
+		for fd in self._pipe:
+			os.close(fd)
+		self._pipe = None
+		self._previous = None
+
+try:
+	_childWatcher = unittest._lousy_child_watcher
+except:
+	_childWatcher = _ChildWatcher()
+
+class OutputLimits(object):
+	'''Limits on how much of the output of a process is kept, logged and read,
+	   to protect the test runner from a runaway child. Each limit applies to
+	   each output stream separately and None disables it.
+
+	   maxBuffered is the number of bytes of unread output kept in memory. When
+	   it is exceeded the oldest and newest halves are kept and the middle is
+	   replaced by TRUNCATION_MARKER.
+
+	   maxLogged is the number of bytes of output which are logged. The rest is
+	   counted but not logged.
+
+	   maxRate is the number of bytes per second read from the child. A child
+	   which writes faster blocks until the output is read.
+
+	   spill is True to write output dropped from the buffer to a temporary
+	   file, or the name of the directory to create that file in.
+	'''
+
+	TRUNCATION_MARKER = '\n[lousy: output truncated]\n'
+
+	def __init__(self, maxBuffered=None, maxLogged=None, maxRate=None, spill=False):
+		self.maxBuffered = maxBuffered
+		self.maxLogged = maxLogged
+		self.maxRate = maxRate
+		self.spill = spill
+
 class ProcessPipe(object):
 	'''File object to interact with processes.
 	   Any output from the process will be output with a prefix and stored until
@@ -1002,11 +1324,24 @@ class ProcessPipe(object):
 	closed = False
 	buffer = ''
 	_mirror = None
+	_poller = None
+	_outgoing = None
+	_outgoingOffset = 0
+	_outgoingSize = 0
+	_limits = None
+	_unthrottled = False
+	_spillFile = None
+	spillPath = None
+	loggedBytes = 0
+	unloggedBytes = 0
+	truncatedBytes = 0
 
 	def __init__(self):
 		self.pipes = os.pipe()
 		self._setCloseExec(self.pipes[0])
 		self._setCloseExec(self.pipes[1])
+		self._setNonBlocking(self.pipes[self._fileno])
+		self._outgoing = collections.deque()
 
 	def setPrefix(self, prefix):
 		self.prefix = prefix
@@ -1017,9 +1352,52 @@ class ProcessPipe(object):
 		'''
 		self._mirror = newMirror
 
+	def limit(self, limits):
+		'''Apply the OutputLimits to the output read from this pipe'''
+		self._limits = limits
+		self._allowance = limits.maxRate
+		self._refillTime = time.time()
+
+	def unthrottle(self):
+		'''Stop applying the rate limit, so whatever output is left can be
+		   collected once the process has exited.
+		'''
+		self._unthrottled = True
+
+	def _rateLimited(self):
+		return self._limits is not None and self._limits.maxRate is not None and \
+				not self._unthrottled
+
+	def throttled(self):
+		'''Returns the number of seconds until more output may be read
+		   because of the rate limit, zero when output may be read now.
+		'''
+		if not self._rateLimited():
+			return 0
+
+		# Token bucket allowing bursts of up to one second of output
+		now = time.time()
+		rate = self._limits.maxRate
+		self._allowance = min(rate, self._allowance + (now - self._refillTime) * rate)
+		self._refillTime = now
+
+		if self._allowance >= 1:
+			return 0
+		return (1 - self._allowance) / rate
+
+	def poller(self, newPoller):
+		'''A poller is a callable which is called with a timeout in place of waiting
+		   for output on this pipe alone. Process uses this to service all of its
+		   pipes from a single loop.
+		'''
+		self._poller = newPoller
+
 	def fileno(self):
 		return self.pipes[self._direction]
 
+	def _parentFileno(self):
+		return self.pipes[self._fileno]
+
 	def _setCloseExec(self, fd):
 		flags = fcntl.fcntl(fd, fcntl.F_GETFD)
 		fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
@@ -1029,13 +1407,177 @@ class ProcessPipe(object):
 		fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
 	def write(self, string):
-		'''Returns number of bytes successfully written'''
+		'''Queue the string to be sent to the process. As much as the process
+		   will accept is written immediately, the remainder is written as the
+		   pipe drains. Returns the number of bytes queued.
+		'''
 		lines = _escapeAscii(string).split('\n')
 		for line in lines[:-1]:
 			print '%s sent: "%s\\n"' % (self.prefix, line)
 		if lines[-1] != '':
 			print '%s sent: "%s"' % (self.prefix, lines[-1])
-		return os.write(self.pipes[self._fileno], string)
+
+		if len(string) > 0 and not self.closed:
+			self._outgoing.append(string)
+			self._outgoingSize += len(string)
+			self.writePending()
+
+		return len(string)
+
+	def pending(self):
+		'''Returns the number of queued bytes which haven't been written yet'''
+		return self._outgoingSize
+
+	def writePending(self):
+		'''Write as much of the queued data as the process will accept without
+		   blocking. Returns the number of bytes still queued.
+		'''
+		while len(self._outgoing) > 0:
+			data = self._outgoing[0]
+			try:
+				written = os.write(self._parentFileno(), buffer(data, self._outgoingOffset))
+			except OSError as e:
+				if e.errno == errno.EAGAIN:
+					break
+				if e.errno == errno.EPIPE:
+					# The process will never read the rest
+					print '%s stdin closed with %d bytes unsent' % (self.prefix, self._outgoingSize)
+					self._outgoing.clear()
+					self._outgoingSize = 0
+					self.closed = True
+					break
+				raise
+
+			self._outgoingSize -= written
+			self._outgoingOffset += written
+			if self._outgoingOffset == len(data):
+				self._outgoing.popleft()
+				self._outgoingOffset = 0
+
+		return self._outgoingSize
+
+	def readAvailable(self):
+		'''Read the output which is available right now into the buffer.
+		   Returns the newly read output.
+		'''
+		size = 102400
+		if self.throttled() > 0:
+			return ''
+		if self._rateLimited():
+			size = min(size, int(self._allowance))
+
+		try:
+			output = os.read(self._parentFileno(), size)
+		except OSError as e:
+			if e.errno == errno.EAGAIN:
+				return ''
+			raise
+
+		if self._rateLimited():
+			self._allowance -= len(output)
+
+		if self._mirror is not None:
+			self._mirror.append(output)
+
+		if len(output) > 0:
+			self._logReceived(output)
+
+		self.buffer += output
+		self._limitBuffer()
+
+		return output
+
+	def _logReceived(self, output):
+		truncated = False
+		if self._limits is not None and self._limits.maxLogged is not None:
+			remaining = self._limits.maxLogged - self.loggedBytes
+			if remaining <= 0:
+				self.unloggedBytes += len(output)
+				return
+			if len(output) > remaining:
+				self.unloggedBytes += len(output) - remaining
+				output = output[:remaining]
+				truncated = True
+		self.loggedBytes += len(output)
+
+		lines = _escapeAscii(output).split('\\n')
+		for line in lines[:-1]:
+			print '%s received: "%s\\n"' % (self.prefix, line)
+		if lines[-1] != '':
+			print '%s received: "%s"' % (self.prefix, lines[-1])
+
+		if truncated:
+			print '%s output logging truncated after %d bytes' % (self.prefix, self.loggedBytes)
+
+	def _limitBuffer(self):
+		if self._limits is None or self._limits.maxBuffered is None:
+			return
+		if len(self.buffer) <= self._limits.maxBuffered + len(OutputLimits.TRUNCATION_MARKER):
+			return
+
+		head_size = self._limits.maxBuffered / 2
+		tail_size = self._limits.maxBuffered - head_size
+		middle = self.buffer[head_size:len(self.buffer) - tail_size]
+
+		# The marker of an earlier truncation isn't output
+		if middle.startswith(OutputLimits.TRUNCATION_MARKER):
+			middle = middle[len(OutputLimits.TRUNCATION_MARKER):]
+
+		if self.truncatedBytes == 0:
+			if self._limits.spill:
+				directory = None
+				if self._limits.spill is not True:
+					directory = self._limits.spill
+				self._spillFile = tempfile.NamedTemporaryFile(prefix='lousy-spill-',
+						dir=directory, delete=False)
+				self.spillPath = self._spillFile.name
+				print '%s output buffer exceeded %d bytes, spilling to %s' % (self.prefix,
+						self._limits.maxBuffered, self.spillPath)
+			else:
+				print '%s output buffer exceeded %d bytes, truncating' % (self.prefix,
+						self._limits.maxBuffered)
+
+		if self.spillPath is not None:
+			if self._spillFile is None:
+				# Output read after closeSpill()
+				self._spillFile = open(self.spillPath, 'ab')
+			self._spillFile.write(middle)
+			self._spillFile.flush()
+
+		self.truncatedBytes += len(middle)
+		self.buffer = self.buffer[:head_size] + OutputLimits.TRUNCATION_MARKER + self.buffer[-tail_size:]
+
+	def closeSpill(self):
+		'''Close the file truncated output is spilled to, if any'''
+		if self._spillFile is not None:
+			self._spillFile.close()
+			self._spillFile = None
+
+	def logLimits(self):
+		'''Log how much output was lost to the OutputLimits, if any'''
+		if self.unloggedBytes > 0:
+			print '%s %d bytes of output were not logged' % (self.prefix, self.unloggedBytes)
+		if self.truncatedBytes > 0:
+			if self.spillPath is not None:
+				print '%s %d bytes of output were truncated, see %s' % (self.prefix,
+						self.truncatedBytes, self.spillPath)
+			else:
+				print '%s %d bytes of output were truncated' % (self.prefix, self.truncatedBytes)
+
+	def wait(self, timeout):
+		'''Wait up to timeout seconds for output and read it into the buffer'''
+		if self._poller is not None:
+			self._poller(timeout)
+			return
+
+		delay = self.throttled()
+		if delay > 0:
+			time.sleep(min(delay, timeout))
+			return
+
+		ready, _, _ = _select([self._parentFileno()], [], timeout)
+		if len(ready) > 0:
+			self.readAvailable()
 
 	def read(self):
 		'''Return a string of all the available output. An empty string is returned when no output is available'''
@@ -1046,25 +1588,9 @@ class ProcessPipe(object):
 		else:
 			timeout = 0.05
 
-		ready, _, _ = select.select([self.pipes[self._fileno]], [], [], timeout)
-		if len(ready) == 0:
-			output = self.buffer
-			self.buffer = ''
-			return output
-
-		output = os.read(self.pipes[self._fileno], 102400)
-
-		if self._mirror is not None:
-			self._mirror.append(output)
-
-		if len(output) > 0:
-			lines = _escapeAscii(output).split('\\n')
-			for line in lines[:-1]:
-				print '%s received: "%s\\n"' % (self.prefix, line)
-			if lines[-1] != '':
-				print '%s received: "%s"' % (self.prefix, lines[-1])
+		self.wait(timeout)
 
-		output = self.buffer + output
+		output = self.buffer
 		self.buffer = ''
 
 		return output
@@ -1077,6 +1603,10 @@ class ProcessPipe(object):
 		'''
 		self.buffer = self.read()
 
+		return self._takeLine(fullLineOnly)
+
+	def _takeLine(self, fullLineOnly):
+		# Return the next line from the output already read without waiting
 		if '\n' in self.buffer:
 			output, self.buffer = self.buffer.split('\n', 1)
 			return output
@@ -1123,16 +1653,790 @@ class PtyProcessPipe(ProcessPipe):
 		self.pipes = os.openpty()
 		self._setTtySize(self.pipes[0], rows, cols)
 		self._setCloseExec(self.pipes[0])
+		self._setNonBlocking(self.pipes[0])
+		self._outgoing = collections.deque()
 
 	def _setTtySize(self, fd, rows, cols):
 		# pack a struct winsize
 		arg = struct.pack('@HHHH', rows, cols, 0, 0)
 		fcntl.ioctl(fd, termios.TIOCSWINSZ, arg)
 
+def _libcFunction(name):
+	'''Returns the named function from the C library, None if it isn't available'''
+	try:
+		return getattr(ctypes.CDLL(None, use_errno=True), name)
+	except (AttributeError, OSError):
+		return None
+
+def _anonymousFile(name):
+	'''Returns a descriptor for a new file which has no name in the filesystem.
+	   A memfd is used where the system provides one, otherwise an unlinked
+	   temporary file.
+	'''
+	memfd_create = _libcFunction('memfd_create')
+	if memfd_create is not None:
+		fd = memfd_create(name, 1) # MFD_CLOEXEC
+		if fd >= 0:
+			return fd
+
+	f = tempfile.TemporaryFile(prefix=name + '-')
+	fd = os.dup(f.fileno())
+	f.close()
+	return fd
+
+class CaptureProcessPipe(ProcessPipe):
+	'''ProcessPipe which captures the output into an anonymous file instead of a pipe.
+	   Nothing is read from it while the process runs, instead the output is
+	   accessed in place through a memory mapping of the file.
+	'''
+
+	_direction = 1
+	_fileno = 1
+
+	def __init__(self):
+		fd = _anonymousFile('lousy-capture')
+		self._setCloseExec(fd)
+		self.pipes = (fd, fd)
+		self._outgoing = collections.deque()
+		self._map = None
+
+	def readAvailable(self):
+		# The descriptor shares its offset with the child so it must never be read
+		return ''
+
+	def size(self):
+		return os.fstat(self.pipes[0]).st_size
+
+	def mapping(self):
+		'''Returns a read-only mmap of the output captured so far, None if there is none'''
+		size = self.size()
+		if size == 0:
+			return None
+
+		if self._map is None or len(self._map) != size:
+			self._map = mmap.mmap(self.pipes[0], size, access=mmap.ACCESS_READ)
+		return self._map
+
+	def view(self):
+		'''Returns a read-only view of the output captured so far without copying it'''
+		m = self.mapping()
+		if m is None:
+			return buffer('')
+		return buffer(m)
+
+def _recvExactly(sock, size):
+	'''Read exactly size bytes from the socket. Returns a shorter string only if the
+	   far end closed the connection.
+	'''
+	chunks = []
+	while size > 0:
+		chunk = sock.recv(size)
+		if not chunk:
+			break
+		chunks.append(chunk)
+		size -= len(chunk)
+	return ''.join(chunks)
+
+def _sendLauncherMessage(sock, obj):
+	msg = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+	sock.sendall(struct.pack(MSG_HEADER_FMT, len(msg)) + msg)
+
+def _readLauncherMessage(sock):
+	'''Returns the next object sent over the launcher socket or None if the socket was
+	   closed.
+	'''
+	header_size = struct.calcsize(MSG_HEADER_FMT)
+	buf = _recvExactly(sock, header_size)
+	if len(buf) < header_size:
+		return None
+	size = struct.unpack(MSG_HEADER_FMT, buf)[0]
+
+	# Read exactly the message so any descriptors following it are left untouched
+	return pickle.loads(_recvExactly(sock, size))
+
+# The exit status and resource usage of a child, as sent by the ProcessLauncher
+_LAUNCHER_STATUS_FMT = '!iddqqq'
+
+ProcessRusage = collections.namedtuple('ProcessRusage', 'ru_utime ru_stime ru_maxrss ru_inblock ru_oublock')
+
+def _returncode(status):
+	'''Convert a wait() status into a returncode in the style of subprocess'''
+	if os.WIFSIGNALED(status):
+		return -os.WTERMSIG(status)
+	return os.WEXITSTATUS(status)
+
+class LaunchedProcess(object):
+	'''The subset of the subprocess.Popen interface used by Process for a child
+	   which was started by a ProcessLauncher. The child isn't our own so the exit
+	   status is delivered by the launcher over a dedicated pipe.
+
+	   The launcher reaps the child, so its pid may be reused before the status
+	   has been read here. Signals are therefore sent by the launcher, which
+	   only does so while the child is still unreaped. Signalling the process
+	   group of a child is still done directly by Process. That is safe as long
+	   as anything is left in the group, since the group id is not reused while
+	   the group exists.
+	'''
+
+	def __init__(self, pid, status_fd, launcher):
+		self.pid = pid
+		self.returncode = None
+		self.rusage = None
+		self._status_fd = status_fd
+		self._status = ''
+		self._launcher = launcher
+		self._lost = False # The launcher exited without reporting the status
+
+	def poll(self):
+		'''Returns the returncode if the child has exited, None otherwise. Raises
+		   OSError if the launcher exited without reporting it.
+		'''
+		if self._lost:
+			raise OSError(errno.EPIPE, 'Process launcher exited without the status of %d' % self.pid)
+		if self.returncode is not None or self._status_fd is None:
+			return self.returncode
+
+		ready, _, _ = _select([self._status_fd], [], 0)
+		if len(ready) == 0:
+			return None
+
+		data = os.read(self._status_fd, 64)
+		self._status += data
+		size = struct.calcsize(_LAUNCHER_STATUS_FMT)
+		if len(self._status) >= size:
+			fields = struct.unpack(_LAUNCHER_STATUS_FMT, self._status[:size])
+			self.returncode = _returncode(fields[0])
+			self.rusage = ProcessRusage(*fields[1:])
+
+		if len(data) == 0 or self.returncode is not None:
+			os.close(self._status_fd)
+			self._status_fd = None
+			if self.returncode is None:
+				self._lost = True
+				return self.poll()
+
+		return self.returncode
+
+	def exitFileno(self):
+		'''Returns a file descriptor which becomes readable when the child exits'''
+		return self._status_fd
+
+	def send_signal(self, sig):
+		if self.poll() is None:
+			self._launcher.signal(self.pid, sig)
+
+	def kill(self):
+		self.send_signal(signal.SIGKILL)
+
+def _inheritOnly(fds):
+	# Runs in a newly forked child. Marks every descriptor other than stdin,
+	# stdout, stderr and fds close-on-exec, and makes sure those in fds are
+	# inherited. Only the descriptors actually open are visited, unlike closing
+	# every possible descriptor number.
+	try:
+		open_fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+	except OSError:
+		open_fds = range(3, os.sysconf('SC_OPEN_MAX'))
+
+	for fd in open_fds:
+		if fd < 3:
+			continue
+		try:
+			flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+			if fd in fds:
+				fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+			else:
+				fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+		except IOError:
+			pass # The descriptor used to list the directory is already closed
+
+class ProcessLauncher(object):
+	'''A small helper process which forks and execs children on behalf of Process.
+
+	   Forking a large test runner once per child is slow since the entire address
+	   space must be duplicated. The launcher is forked once while the runner is
+	   still small and from then on receives spawn requests over a socket. The
+	   child ends of the pipes or pty are passed to the launcher with SCM_RIGHTS and
+	   the exit status of each child is written back over a per-child status pipe.
+
+	   Use 'lousy run --launcher' to have all Process objects use a launcher.
+	'''
+
+	pid = None
+
+	def __init__(self):
+		self._sock = None
+		self._lock = threading.Lock()
+
+	def start(self):
+		'''Fork the helper process. This should be called as early as possible, before
+		   the test runner has grown large or started any threads.
+		'''
+		ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+		pid = os.fork()
+		if pid == 0:
+			try:
+				ours.close()
+				self._serve(theirs)
+			finally:
+				os._exit(0)
+
+		theirs.close()
+		self._sock = ours
+		self.pid = pid
+
+	def stop(self):
+		'''Stop the helper process. Children which are still running are left alone.'''
+		if self.pid is None:
+			return
+
+		self._sock.close()
+		os.waitpid(self.pid, 0)
+		self.pid = None
+
+	def signal(self, pid, sig):
+		'''Send the signal to the child pid spawned by this launcher, unless the
+		   launcher has already reaped it. Returns True if the signal was sent.
+		'''
+		with self._lock:
+			if self.pid is None:
+				raise OSError(errno.EPIPE, 'Process launcher has exited')
+			_sendLauncherMessage(self._sock, {'signal': sig, 'pid': pid})
+			reply = _readLauncherMessage(self._sock)
+
+		if reply is None:
+			raise OSError(errno.EPIPE, 'Process launcher has exited')
+		if 'error' in reply:
+			raise OSError(reply['error'], os.strerror(reply['error']))
+		return reply['sent']
+
+	def spawn(self, args, stdin, stdout, stderr, newProcessGroup=False, env=None, cwd=None,
+			passFds=()):
+		'''Spawn the command list args with the given file descriptors as its stdin,
+		   stdout and stderr. If newProcessGroup is True the child is made the
+		   leader of a new process group. env and cwd are the environment and
+		   working directory of the child, the launcher's by default. The
+		   descriptors in passFds are inherited by the child with the same
+		   numbers, no others are. Returns a LaunchedProcess.
+		'''
+		status_r, status_w = os.pipe()
+		passFds = sorted(set(passFds))
+		request = {
+				'args': args,
+				'newProcessGroup': newProcessGroup,
+				'env': env,
+				'cwd': cwd,
+				'passFds': passFds,
+				}
+
+		with self._lock:
+			_sendLauncherMessage(self._sock, request)
+			for fd in [stdin, stdout, stderr, status_w] + passFds:
+				_multiprocessing.sendfd(self._sock.fileno(), fd)
+			os.close(status_w)
+
+			reply = _readLauncherMessage(self._sock)
+
+		if reply is None:
+			os.close(status_r)
+			raise OSError(errno.EPIPE, 'Process launcher has exited')
+		if 'error' in reply:
+			os.close(status_r)
+			raise OSError(reply['error'], os.strerror(reply['error']))
+
+		flags = fcntl.fcntl(status_r, fcntl.F_GETFD)
+		fcntl.fcntl(status_r, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+		return LaunchedProcess(reply['pid'], status_r, self)
+
+	def _serve(self, sock):
+		# Runs in the helper process. The helper must exit when the runner goes
+		# away, not when the user hits Ctrl-C in the runner's terminal.
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+		wakeup_r, wakeup_w = os.pipe()
+		for fd in (sock.fileno(), wakeup_r, wakeup_w):
+			flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+			fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+		flags = fcntl.fcntl(wakeup_w, fcntl.F_GETFL)
+		fcntl.fcntl(wakeup_w, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+		def sigchld(signum, frame):
+			try:
+				os.write(wakeup_w, 'c')
+			except OSError:
+				pass
+		signal.signal(signal.SIGCHLD, sigchld)
+		signal.siginterrupt(signal.SIGCHLD, False)
+
+		children = {} # pid -> status pipe
+
+		while True:
+			try:
+				ready, _, _ = select.select([sock, wakeup_r], [], [])
+			except select.error as e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+
+			if wakeup_r in ready:
+				os.read(wakeup_r, 1024)
+				self._reap(children)
+
+			if sock in ready:
+				request = _readLauncherMessage(sock)
+				if request is None:
+					return
+
+				if 'signal' in request:
+					# Only a child which hasn't been reaped still owns its pid
+					self._reap(children)
+					reply = {'sent': False}
+					if request['pid'] in children:
+						try:
+							os.kill(request['pid'], request['signal'])
+							reply = {'sent': True}
+						except OSError as e:
+							reply = {'error': e.errno}
+					_sendLauncherMessage(sock, reply)
+					continue
+
+				count = 4 + len(request['passFds'])
+				fds = [_multiprocessing.recvfd(sock.fileno()) for i in range(count)]
+				for fd in fds:
+					flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+					fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+				status_w = fds.pop(3)
+				try:
+					pid = self._spawnChild(request, fds)
+				except OSError as e:
+					_sendLauncherMessage(sock, {'error': e.errno})
+					for fd in fds + [status_w]:
+						os.close(fd)
+					continue
+
+				for fd in fds:
+					os.close(fd)
+				children[pid] = status_w
+				_sendLauncherMessage(sock, {'pid': pid})
+
+				# The child may have exited before it was registered
+				self._reap(children)
+
+	def _reap(self, children):
+		while len(children) > 0:
+			try:
+				pid, status, rusage = os.wait4(-1, os.WNOHANG)
+			except OSError as e:
+				if e.errno == errno.ECHILD:
+					return
+				raise
+			if pid == 0:
+				return
+
+			if pid in children:
+				status_w = children.pop(pid)
+				os.write(status_w, struct.pack(_LAUNCHER_STATUS_FMT, status,
+						rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss,
+						rusage.ru_inblock, rusage.ru_oublock))
+				os.close(status_w)
+
+	def _spawnChild(self, request, fds):
+		# fds are the descriptors for stdin, stdout and stderr followed by those
+		# to be passed to the child. Exec failures are reported back through a
+		# close-on-exec pipe.
+		err_r, err_w = os.pipe()
+		flags = fcntl.fcntl(err_w, fcntl.F_GETFD)
+		fcntl.fcntl(err_w, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+		pid = os.fork()
+		if pid == 0:
+			try:
+				os.close(err_r)
+				targets = [0, 1, 2] + request['passFds']
+
+				# Move everything out of the way first so that no descriptor
+				# is overwritten before it has been moved to its target
+				lowest = max(targets + [err_w]) + 1
+				fds = [fcntl.fcntl(fd, fcntl.F_DUPFD, lowest) for fd in fds]
+				for fd, target in zip(fds, targets):
+					os.dup2(fd, target)
+				_inheritOnly(request['passFds'])
+
+				signal.signal(signal.SIGINT, signal.SIG_DFL)
+				signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+				if request['newProcessGroup']:
+					os.setpgrp()
+
+				if request['cwd'] is not None:
+					os.chdir(request['cwd'])
+
+				args = request['args']
+				if request['env'] is not None:
+					os.execvpe(args[0], args, request['env'])
+				else:
+					os.execvp(args[0], args)
+			except OSError as e:
+				os.write(err_w, struct.pack('!i', e.errno))
+			finally:
+				os._exit(255)
+
+		os.close(err_w)
+		data = ''
+		while True:
+			chunk = os.read(err_r, 4)
+			if not chunk:
+				break
+			data += chunk
+		os.close(err_r)
+
+		if len(data) > 0:
+			os.waitpid(pid, 0)
+			raise OSError(struct.unpack('!i', data[:4])[0], 'exec failed')
+
+		return pid
+
+class ProcessUsage(object):
+	'''The resources consumed by a Process. While the child is running its
+	   /proc entry is sampled at most every sampleInterval seconds. Once it has
+	   exited the rusage from wait4() is available as well.
+
+	   samples is a list of (time, rss bytes, cpu seconds, read bytes, written bytes)
+	   tuples. rusage is a ProcessRusage, or None if the child hasn't been reaped.
+	'''
+
+	sampleInterval = 0.5
+
+	_clockTicks = os.sysconf('SC_CLK_TCK')
+	_pageSize = os.sysconf('SC_PAGE_SIZE')
+
+	def __init__(self, command, pid):
+		self.command = command
+		self.pid = pid
+		self.startTime = time.time()
+		self.endTime = None
+		self.samples = []
+		self.rusage = None
+		self.readyTime = None
+		self._lastSample = 0
+
+	def sample(self):
+		'''Sample the /proc entry of the child if the sample interval has passed'''
+		now = time.time()
+		if self.endTime is not None or now - self._lastSample < self.sampleInterval:
+			return
+		self._lastSample = now
+
+		try:
+			with open('/proc/%d/stat' % self.pid) as f:
+				stat = f.read()
+			# The command name may contain spaces, the fields follow the last ')'
+			fields = stat[stat.rindex(')') + 2:].split()
+			cpu = float(int(fields[11]) + int(fields[12])) / self._clockTicks
+			rss = int(fields[21]) * self._pageSize
+
+			read_bytes = 0
+			write_bytes = 0
+			with open('/proc/%d/io' % self.pid) as f:
+				for line in f:
+					name, value = line.split(':')
+					if name == 'read_bytes':
+						read_bytes = int(value)
+					elif name == 'write_bytes':
+						write_bytes = int(value)
+		except (IOError, ValueError, IndexError):
+			# The child is gone or this isn't Linux
+			return
+
+		self.samples.append((now, rss, cpu, read_bytes, write_bytes))
+
+	def finish(self, rusage):
+		'''Record that the child has exited with the given ProcessRusage'''
+		self.endTime = time.time()
+		self.rusage = rusage
+
+	def runtime(self):
+		if self.endTime is None:
+			return time.time() - self.startTime
+		return self.endTime - self.startTime
+
+	def cpuTime(self):
+		'''Returns the user plus system CPU seconds used by the child'''
+		if self.rusage is not None:
+			return self.rusage.ru_utime + self.rusage.ru_stime
+		if len(self.samples) > 0:
+			return self.samples[-1][2]
+		return 0.0
+
+	def maxRss(self):
+		'''Returns the peak resident set size of the child in bytes'''
+		if self.rusage is not None:
+			# Linux reports kilobytes
+			return self.rusage.ru_maxrss * 1024
+		return max([0] + [sample[1] for sample in self.samples])
+
+	def ioBytes(self):
+		'''Returns the tuple (bytes read, bytes written) from the last sample'''
+		if len(self.samples) > 0:
+			return self.samples[-1][3], self.samples[-1][4]
+		return 0, 0
+
+def _recordProcessUsage(usage):
+	# The runner collects the usage of the processes each test starts in the
+	# TestTiming of the test, see lousy run.
+	records = getattr(unittest, '_lousy_process_usage', None)
+	if records is not None:
+		records.append(usage)
+
+def _pumpProcesses(processes, timeout, watchExit=False, waiters=()):
+	'''Wait up to timeout for output from any of the processes while writing
+	   their queued input as they accept it. Reading and writing from the same
+	   loop prevents deadlocking on a child which only reads its input once its
+	   output has been consumed. With watchExit the wait also ends when any of
+	   the children may have exited. waiters are other objects, such as
+	   ReadinessProbes, with descriptors to wait on in the same select. Returns
+	   True if any output was read.
+	'''
+	readers = []
+	writers = []
+	watcher_fd = None
+	for proc in list(processes) + list(waiters):
+		proc_readers, proc_writers, proc_timeout = proc._waitSet()
+		readers.extend(proc_readers)
+		writers.extend(proc_writers)
+		if proc_timeout is not None:
+			timeout = min(timeout, proc_timeout)
+
+		if watchExit and proc in processes and proc.running:
+			exit_fd = proc._exitFileno()
+			if exit_fd is None:
+				# No notification is possible, poll instead
+				timeout = min(timeout, 0.05)
+			else:
+				readers.append(exit_fd)
+				if not hasattr(proc.process, 'exitFileno'):
+					watcher_fd = exit_fd
+
+	readable, writable, _ = _select(readers, writers, timeout)
+
+	if watcher_fd is not None and watcher_fd in readable:
+		_childWatcher.clear()
+
+	output = False
+	for proc in processes:
+		if proc._service(readable, writable):
+			output = True
+		if proc.running:
+			proc.usage.sample()
+
+	for waiter in waiters:
+		waiter._service(readable, writable)
+
+	return output
+
+class ReadinessProbe(object):
+	'''Base class of the conditions Process.waitUntilReady() waits for to decide
+	   that a process has finished starting up. Each probe supplies descriptors
+	   for the shared select and checks its condition when they are ready.
+	'''
+
+	ready = False
+
+	def start(self, process):
+		'''Begin probing for the process'''
+		self.ready = False
+
+	def stop(self):
+		'''Release anything held while probing'''
+		pass
+
+	def _waitSet(self):
+		# Returns the descriptors to wait on for reading and writing and the
+		# longest to wait, or None for no limit.
+		return [], [], None
+
+	def _service(self, readable, writable):
+		pass
+
+class SocketProbe(ReadinessProbe):
+	'''Ready once a connection to the address is accepted. There is no way to
+	   be notified that a socket has started listening, so refused connections
+	   are retried every retryInterval seconds.
+	'''
+
+	retryInterval = 0.05
+
+	def __init__(self, family, address):
+		self.family = family
+		self.address = address
+		self._sock = None
+		self._retryTime = 0
+
+	def start(self, process):
+		ReadinessProbe.start(self, process)
+		self._connect()
+
+	def stop(self):
+		if self._sock is not None:
+			self._sock.close()
+			self._sock = None
+
+	def _connect(self):
+		self.stop()
+		self._sock = socket.socket(self.family, socket.SOCK_STREAM)
+		self._sock.setblocking(0)
+		self._finish(self._sock.connect_ex(self.address))
+
+	def _finish(self, err):
+		if err == 0:
+			self.ready = True
+			self.stop()
+		elif err not in (errno.EINPROGRESS, errno.EAGAIN):
+			# Not listening yet
+			self.stop()
+			self._retryTime = time.time() + self.retryInterval
+
+	def _waitSet(self):
+		if self._sock is not None:
+			return [], [self._sock.fileno()], None
+		return [], [], max(0, self._retryTime - time.time())
+
+	def _service(self, readable, writable):
+		if self.ready:
+			return
+		if self._sock is None:
+			if time.time() >= self._retryTime:
+				self._connect()
+		elif self._sock.fileno() in writable:
+			self._finish(self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR))
+
+class TcpProbe(SocketProbe):
+	'''Ready once a TCP connection to port on host is accepted'''
+
+	def __init__(self, port, host='127.0.0.1'):
+		SocketProbe.__init__(self, socket.AF_INET, (host, port))
+
+class UnixProbe(SocketProbe):
+	'''Ready once a connection to the UNIX domain socket at path is accepted'''
+
+	def __init__(self, path):
+		SocketProbe.__init__(self, socket.AF_UNIX, path)
+
+class FileProbe(ReadinessProbe):
+	'''Ready once a file exists at path. The directory containing it is watched
+	   with inotify where possible, otherwise the path is checked every
+	   retryInterval seconds.
+	'''
+
+	retryInterval = 0.05
+
+	IN_MOVED_TO = 0x80
+	IN_CREATE = 0x100
+	IN_NONBLOCK = 0x800
+	IN_CLOEXEC = 0x80000
+
+	def __init__(self, path):
+		self.path = path
+		self._inotify = None
+
+	def start(self, process):
+		ReadinessProbe.start(self, process)
+
+		inotify_init1 = _libcFunction('inotify_init1')
+		inotify_add_watch = _libcFunction('inotify_add_watch')
+		if inotify_init1 is not None and inotify_add_watch is not None:
+			fd = inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+			if fd >= 0:
+				directory = os.path.dirname(os.path.abspath(self.path))
+				if inotify_add_watch(fd, directory, self.IN_CREATE | self.IN_MOVED_TO) >= 0:
+					self._inotify = fd
+				else:
+					os.close(fd)
+
+		# The file may have been created before the watch was added
+		self._check()
+
+	def stop(self):
+		if self._inotify is not None:
+			os.close(self._inotify)
+			self._inotify = None
+
+	def _check(self):
+		if os.path.exists(self.path):
+			self.ready = True
+			self.stop()
+
+	def _waitSet(self):
+		if self._inotify is not None:
+			return [self._inotify], [], None
+		return [], [], self.retryInterval
+
+	def _service(self, readable, writable):
+		if self.ready:
+			return
+		if self._inotify is not None:
+			if self._inotify not in readable:
+				return
+			try:
+				os.read(self._inotify, 4096)
+			except OSError as e:
+				if e.errno != errno.EAGAIN:
+					raise
+		self._check()
+
+class OutputProbe(ReadinessProbe):
+	'''Ready once a line of the process output matches the regex. The output
+	   isn't consumed, it remains available to be read afterwards. stream is
+	   either 'stdout' or 'stderr'.
+	'''
+
+	def __init__(self, regex, stream='stdout'):
+		self.regex = regex
+		self.stream = stream
+		self._pipe = None
+		self._checked = 0
+
+	def start(self, process):
+		ReadinessProbe.start(self, process)
+		self.regex = regexCache.compile(self.regex)
+		self._pipe = process._pipe(self.stream)
+		self._checked = 0
+		self._check()
+
+	def _check(self):
+		buffer = self._pipe.buffer
+		if len(buffer) < self._checked:
+			# Some has been read since, start again
+			self._checked = 0
+
+		end = buffer.rfind('\n') + 1
+		if end <= self._checked:
+			return
+		for line in buffer[self._checked:end].split('\n'):
+			if self.regex.search(line.translate(None, '\r')) is not None:
+				self.ready = True
+				return
+		self._checked = end
+
+	def _service(self, readable, writable):
+		if not self.ready:
+			self._check()
+
+ProcessResult = collections.namedtuple('ProcessResult', 'process returncode runtime')
+
 class Process(object):
 	'''Class for interacting with processes'''
 
-	def __init__(self, command, shell=False, pty=False, ptySize=(24, 80)):
+	# Bytes of unread merged lines kept unless mergedOutput is set, the oldest
+	# are dropped first
+	mergedOutputKept = 1048576
+
+	def __init__(self, command, shell=False, pty=False, ptySize=(24, 80), newProcessGroup=False,
+			outputLimits=None, capture=False, vtyMode='immediate', env=None, cwd=None,
+			close_fds=False, pass_fds=(), preexec=None, stub=False, mergedOutput=False):
 		'''command a list of the command and then arguments to run as the process
 		   shell is True if the command should be run in the shell and False otherwise.
 		   pty is whether to use a pty or a normal pipe to communicate with the process.
@@ -1150,115 +2454,612 @@ class Process(object):
 		   ptySize is the tuple (rows, cols) for the size of the newly created pty.
 		   Defaults to (24, 80).
 
+		   vtyMode is the mode of the Vtty, see Vtty for the valid values. 'lazy'
+		   is cheaper when the screen is only examined occasionally, such as at
+		   the end of the test. 'thread' keeps reading the output promptly when
+		   interpreting it is slow.
+
 		   If shell is True then the command list is converted into a space separate string
 		   to be interpretted by the shell.
+
+		   If newProcessGroup is True the child is made the leader of its own process
+		   group and signals are sent to the whole group. This ensures that any
+		   processes the child starts, such as those started by the shell, are
+		   terminated along with it.
+
+		   outputLimits is an OutputLimits object restricting how much of the output is
+		   kept in memory, logged and read per second. Defaults to no limits.
+
+		   The lines of stdout and stderr are also kept in the order they were
+		   received, for readMergedLine() and the stream='both' readers. Only the
+		   newest mergedOutputKept bytes of these which haven't been read yet are
+		   kept. Set mergedOutput to True to keep them all, such as when a lot of
+		   merged output is only examined after the process has exited.
+
+		   If capture is True stdout is written to an anonymous file instead of a pipe.
+		   It is then not available through the read*() and expect*() methods but
+		   can be accessed in place, without copying, through outputView(),
+		   searchOutput() and findAllOutput(). This is much faster for very large
+		   outputs. capture can't be used with pty.
+
+		   env is a dictionary to use as the environment of the process and cwd the
+		   directory to run it in, both defaulting to those of the test. Setting them
+		   here avoids wrapping the command in a shell to do it.
+
+		   If close_fds is True the process only inherits stdin, stdout and stderr
+		   from the test, along with any descriptors listed in pass_fds. Passing any
+		   descriptors implies close_fds.
+
+		   preexec is a callable which is called in the child just before the
+		   command is executed.
+
+		   stub tells the process how to connect back to StubCentral as a stub
+		   through its environment. StubClient uses these automatically.
+		   Valid values for stub:
+		     False - Don't tell the process anything
+		     True  - Set LOUSY_STUB_PATH to the UNIX domain socket stubs
+		             connect to
+		     tcp   - As True and also set LOUSY_STUB_PORT to the TCP port
+		             stubs connect to, for processes which can't use the
+		             UNIX domain socket. Only this binds the TCP port.
+		     pair  - As True and also pass the process one end of an already
+		             connected socketpair, its descriptor number in LOUSY_STUB_FD.
+		             The process must still register the stub over it.
+
+		   When lousy is run with --launcher the process is forked by the ProcessLauncher
+		   helper instead of by the test process itself. This is much faster when the
+		   test process is large. A process with a preexec is always forked by the test
+		   process since the callable can't be passed to the launcher. Processes
+		   started by the launcher never inherit descriptors other than pass_fds.
 		'''
 
+		if capture and pty:
+			raise ValueError('capture cannot be used with a pty')
+
 		if pty == True or type(pty) == type('string'):
 			self.stdin = PtyProcessPipe(ptySize[0], ptySize[1])
 			self.stdout = self.stdin
 			self.stderr = self.stdin
 
+			self.vty = None
 			if pty != True:
-				self.vty = Vtty(pty)
+				self.vty = Vtty(pty, vtyMode)
 				self.stdout.mirror(self.vty)
 		else:
 			self.stdin = InProcessPipe()
-			self.stdout = OutProcessPipe()
+			if capture:
+				self.stdout = CaptureProcessPipe()
+			else:
+				self.stdout = OutProcessPipe()
 			self.stderr = OutProcessPipe()
 			self.vty = None
 
 		self.returncode = None
 		self.running = False
+		self.newProcessGroup = newProcessGroup
+		self._groupKilled = False
+		self._killGroupOnExit = False
+		self.endTime = None
 
 		if shell:
 			cmd = ' '.join(command)
 		else:
 			cmd = command
-		self.process = subprocess.Popen(cmd, shell=shell, stdin=self.stdin, stdout=self.stdout,
-				                stderr=self.stderr)
 
+		inherit = list(pass_fds)
+		stubSocket = None
+		if stub:
+			if env is None:
+				env = os.environ
+			env = dict(env)
+			env[STUB_PATH_ENV] = stubs.path()
+			if stub == 'tcp':
+				env[STUB_PORT_ENV] = str(stubs.port())
+			elif stub == 'pair':
+				stubSocket = stubs.socketpair()
+				env[STUB_FD_ENV] = str(stubSocket.fileno())
+				inherit.append(stubSocket.fileno())
+
+		if pass_fds:
+			close_fds = True
+
+		if launcher is not None and preexec is None:
+			if shell:
+				args = ['/bin/sh', '-c', cmd]
+			else:
+				args = list(cmd)
+			self.process = launcher.spawn(args, self.stdin.fileno(), self.stdout.fileno(),
+					self.stderr.fileno(), newProcessGroup, env, cwd, inherit)
+		else:
+			if newProcessGroup or close_fds or preexec is not None or stubSocket is not None:
+				def preexec_fn():
+					if newProcessGroup:
+						os.setpgrp()
+					if close_fds:
+						_inheritOnly(inherit)
+					elif stubSocket is not None:
+						fd = stubSocket.fileno()
+						flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+						fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+					if preexec is not None:
+						preexec()
+			else:
+				preexec_fn = None
+
+			# subprocess would close every possible descriptor number itself so
+			# close_fds is handled by marking the open ones close-on-exec instead
+			self.process = subprocess.Popen(cmd, shell=shell, stdin=self.stdin, stdout=self.stdout,
+					                stderr=self.stderr, preexec_fn=preexec_fn, env=env, cwd=cwd)
+
+		if stubSocket is not None:
+			# The child has its own copy now
+			stubSocket.close()
+
+		self.startTime = time.time()
 		self.running = True
 
+		self.usage = ProcessUsage(command, self.process.pid)
+		_recordProcessUsage(self.usage)
+
 		prefix = '[ %s(%d) ]' % (command[0], self.process.pid)
 
 		self.stdin.setPrefix(prefix)
 		self.stdout.setPrefix(prefix)
-		self.stderr.setPrefix(prefix)
-
-	def terminate(self):
-		'''Forcefully terminate the child process if it hasn't already terminated'''
+		if self.stderr is not self.stdout:
+			self.stderr.setPrefix(prefix + ' stderr')
+
+		# Both output streams are drained together so a child writing heavily
+		# to one of them can't block while we wait on the other. Complete lines
+		# from either are also kept in a merged view in the order received, if
+		# it is wanted.
+		self._streams = [('stdout', self.stdout)]
+		if capture:
+			self._streams = []
+			self.stdout.poller(self._pump)
+		if self.stderr is not self.stdout:
+			self._streams.append(('stderr', self.stderr))
+		self.capture = capture
+		self._sequence = 0
+		self.mergedOutput = mergedOutput
+		self._merged = collections.deque()
+		self._mergedBytes = 0
+		self._partial = {} # stream -> fragments of the incomplete last line
+		self._partialBytes = {}
+		for name, pipe in self._streams:
+			self._partial[name] = []
+			self._partialBytes[name] = 0
+			pipe.poller(self._pump)
+
+		self.outputLimits = outputLimits
+		if outputLimits is not None:
+			for name, pipe in self._streams:
+				pipe.limit(outputLimits)
+
+	def terminate(self, graceful_timeout=0):
+		'''Terminate the child process if it hasn't already terminated.
+		   If graceful_timeout is greater than zero the child is first sent
+		   SIGTERM and given that many seconds to exit before it is forcefully
+		   killed. With newProcessGroup anything left in the group once the
+		   child has exited is killed as well.
+		'''
 		if self.running:
-			self.process.kill()
+			if graceful_timeout > 0:
+				self._killGroupOnExit = True
+				self.sendSignal(signal.SIGTERM)
+				if self.waitForTermination(graceful_timeout):
+					return
+			self.sendSignal(signal.SIGKILL)
 			self.waitForTermination()
 			self.returncode = self.process.returncode
 
-	def waitForTermination(self, timeout=5):
+	def sendSignal(self, sig):
+		'''Send the signal to the child, or to its entire process group if it
+		   was started with newProcessGroup. Nothing is sent once the child
+		   has been seen to terminate.
+		'''
+		if not self.running:
+			# The process id, and so the group id, may have been reused
+			return
+		if self.newProcessGroup:
+			self._signalGroup(sig)
+		else:
+			self.process.send_signal(sig)
+
+	def _signalGroup(self, sig):
+		try:
+			os.killpg(self.process.pid, sig)
+		except OSError as e:
+			if e.errno != errno.ESRCH:
+				raise
+
+	def _killGroup(self):
+		# Kill whatever is left of the process group of a child being
+		# terminated, such as grandchildren which ignored SIGTERM. This is only
+		# done once, by _reap() straight after reaping the child, since any
+		# later the group id could belong to an unrelated process.
+		if self.newProcessGroup and not self._groupKilled:
+			self._groupKilled = True
+			self._signalGroup(signal.SIGKILL)
+
+	def runtime(self):
+		'''Returns the number of seconds the child ran for, or has been running for
+		   if it hasn't terminated yet.
+		'''
+		if self.endTime is None:
+			return time.time() - self.startTime
+		return self.endTime - self.startTime
+
+	def waitForTermination(self, timeout=5):
 		'''Wait until the timeout for the child to terminate gracefully.
 		   Returns True if the child gracefully terminated before the timeout, False otherwise.'''
 		if not self.running:
 			return True
 
 		startTime = time.time()
-		while self.process.poll() is None:
-			if time.time() - startTime > timeout:
+		while not self._reap(startTime + timeout):
+			timeLeft = timeout - (time.time() - startTime)
+			if timeLeft <= 0:
 				return False
-			self.flushOutput()
+			self._pump(timeLeft, watchExit=True)
+
+		return True
+
+	def waitUntilReady(self, probes, timeout=5):
+		'''Wait until the timeout for every one of the ReadinessProbes in probes to
+		   succeed, reading the output of the process while waiting. All the probes
+		   are waited on together without polling where the system allows.
+		   Returns the number of seconds from starting the process until it was
+		   ready, which is also recorded with its resource usage in the test
+		   timing. Returns None if the timeout expires or the process exits first.
+		'''
+		deadline = time.time() + timeout
+		for probe in probes:
+			probe.start(self)
+
+		try:
+			while True:
+				pending = [probe for probe in probes if not probe.ready]
+				if len(pending) == 0:
+					self.usage.readyTime = time.time() - self.startTime
+					return self.usage.readyTime
+
+				if self._reap(deadline):
+					# The last of the output may have made it ready
+					for probe in pending:
+						probe._service([], [])
+					if all([probe.ready for probe in pending]):
+						continue
+					return None
+
+				timeLeft = deadline - time.time()
+				if timeLeft <= 0:
+					return None
+				_pumpProcesses([self], timeLeft, watchExit=True, waiters=pending)
+		finally:
+			for probe in probes:
+				probe.stop()
+
+	def _reap(self, deadline):
+		# Returns True if the child has exited, collecting whatever output is left
+		# now that it is gone.
+		if not self.running:
+			return True
+		if self._poll() is None:
+			return False
+
+		self.endTime = time.time()
+		if self._killGroupOnExit:
+			self._killGroup()
+
+		# Nothing more will be written so the rate limit would only lose the
+		# end of the output
+		for name, pipe in self._streams:
+			pipe.unthrottle()
+		while self._pump(0) and time.time() < deadline:
+			pass
+
+		for name, pipe in self._streams:
+			pipe.logLimits()
+			pipe.closeSpill()
+
+		if self.vty is not None:
+			self.vty.close()
+
 		self.running = False
 		self.returncode = self.process.returncode
 		return True
 
+	def _poll(self):
+		# Check whether the child has exited, collecting its resource usage if so
+		if self.process.returncode is not None:
+			return self.process.returncode
+
+		rusage = None
+		if hasattr(self.process, 'exitFileno'):
+			self.process.poll()
+			rusage = self.process.rusage
+		else:
+			try:
+				pid, status, usage = os.wait4(self.process.pid, os.WNOHANG)
+			except OSError as e:
+				if e.errno != errno.ECHILD:
+					raise
+				# Reaped elsewhere, let subprocess sort it out
+				self.process.poll()
+			else:
+				if pid != 0:
+					self.process.returncode = _returncode(status)
+					rusage = ProcessRusage(usage.ru_utime, usage.ru_stime,
+							usage.ru_maxrss, usage.ru_inblock, usage.ru_oublock)
+
+		if self.process.returncode is not None:
+			self.usage.finish(rusage)
+
+		return self.process.returncode
+
+	def _exitFileno(self):
+		# Children started by a ProcessLauncher report their exit over a pipe,
+		# our own children through SIGCHLD.
+		if hasattr(self.process, 'exitFileno'):
+			return self.process.exitFileno()
+		return _childWatcher.fileno()
+
+	def _pump(self, timeout, watchExit=False):
+		return _pumpProcesses([self], timeout, watchExit)
+
+	def _waitSet(self):
+		# Returns the descriptors to wait on for reading and writing and the
+		# longest to wait, or None for no limit. Output which is rate limited
+		# isn't waited on until more may be read.
+		readers = []
+		timeout = None
+		for name, pipe in self._streams:
+			delay = pipe.throttled()
+			if delay > 0:
+				if timeout is None or delay < timeout:
+					timeout = delay
+			else:
+				readers.append(pipe._parentFileno())
+
+		writers = []
+		if self.stdin.pending() > 0:
+			writers.append(self.stdin._parentFileno())
+		return readers, writers, timeout
+
+	def _service(self, readable, writable):
+		# Handle the descriptors which select() found ready. Returns True if
+		# output was read.
+		if self.stdin._parentFileno() in writable:
+			self.stdin.writePending()
+
+		output = False
+		for name, pipe in self._streams:
+			if pipe._parentFileno() in readable:
+				data = pipe.readAvailable()
+				self._recordOutput(name, data)
+				if len(data) > 0:
+					output = True
+
+		return output
+
+	def _recordOutput(self, stream, output):
+		if output == '':
+			return
+
+		# Fragments of a long line are only joined once it is complete
+		fragments = self._partial[stream]
+		fragments.append(output)
+		self._partialBytes[stream] += len(output)
+		if '\n' in output:
+			lines = ''.join(fragments).split('\n')
+			last = lines.pop()
+			self._partial[stream] = [last]
+			self._partialBytes[stream] = len(last)
+			for line in lines:
+				self._sequence += 1
+				self._merged.append((self._sequence, stream, line))
+				self._mergedBytes += len(line) + 1
+
+		# The merged view only keeps the newest output within the buffer limit
+		limit = None
+		if self.outputLimits is not None and self.outputLimits.maxBuffered is not None:
+			limit = self.outputLimits.maxBuffered
+		if not self.mergedOutput and (limit is None or self.mergedOutputKept < limit):
+			limit = self.mergedOutputKept
+		if limit is not None:
+			while self._mergedBytes > limit and len(self._merged) > 1:
+				seq, name, line = self._merged.popleft()
+				self._mergedBytes -= len(line) + 1
+			# Trimmed only once well over the limit so as not to copy every time
+			if self._partialBytes[stream] > 2 * limit:
+				self._partial[stream] = [''.join(self._partial[stream])[-limit:]]
+				self._partialBytes[stream] = limit
+
+	def _pipe(self, stream):
+		if stream == 'stdout':
+			return self.stdout
+		elif stream == 'stderr':
+			return self.stderr
+		else:
+			raise ValueError('%s is not a valid output stream' % stream)
+
 	def flushOutput(self):
 		'''Wait until all the output from the process has been read and then return'''
 		while self.stdout.read() != '':
 			pass
 
+	def flushInput(self, timeout=5):
+		'''Wait until all the queued input has been written to the process or the
+		   timeout expires. Output is read into the buffer while waiting.
+		   Returns True if all the input was written, False otherwise.
+		'''
+		startTime = time.time()
+		while self.stdin.pending() > 0:
+			timeLeft = timeout - (time.time() - startTime)
+			if timeLeft <= 0:
+				return False
+			self._pump(min(timeLeft, 0.05))
+		return True
+
 	def send(self, text):
-		'''Send the given characters to the process with no interpretation'''
+		'''Send the given characters to the process with no interpretation. Any
+		   input the process isn't ready to accept is queued and written as the
+		   process reads it, see flushInput().
+		'''
 		self.stdin.write(text)
 
+	def sendAll(self, data, timeout=5):
+		'''Send the given characters to the process and wait until they have all
+		   been written or the timeout expires. Returns True if all the data was
+		   written, False otherwise.
+		'''
+		self.send(data)
+		return self.flushInput(timeout)
+
 	def read(self):
 		'''Return a string of all the available output. An empty string is returned when no output is available'''
 		self.stdout.read()
 
-	def readLine(self, fullLineOnly=True):
+	def readLine(self, fullLineOnly=True, stream='stdout'):
 		'''Return a string with the next available line of output from
 		   the process. The trailing newline is trimmed.
 		   None is returned when no line is available.
 		   fullLineOnly=False will return a partial line if it is next in the queue.
+		   stream is one of 'stdout', 'stderr' or 'both'. Each stream is consumed
+		   independently, 'both' returns the lines of stdout and stderr in the
+		   order they were received.
 		'''
-		return self.stdout.readLine(fullLineOnly)
+		if stream != 'both':
+			return self._pipe(stream).readLine(fullLineOnly)
 
-	def readSimple(self, fullLineOnly=True):
+		entry = self.readMergedLine(fullLineOnly)
+		if entry is None:
+			return None
+		return entry[2]
+
+	def readMergedLine(self, fullLineOnly=True):
+		'''Return the next line of the merged view of stdout and stderr as the
+		   tuple (sequence number, stream name, line). The sequence numbers
+		   give the order the lines were received in across both streams.
+		   None is returned when no line is available.
+		   fullLineOnly=False will return a partial line if no full line is available.
+
+		   Unless the process was started with mergedOutput only the newest
+		   lines are kept, see mergedOutputKept.
+		'''
+		if len(self._merged) == 0:
+			self._pump(0.05)
+
+		return self._takeMergedLine(fullLineOnly)
+
+	def _takeMergedLine(self, fullLineOnly):
+		# Return the next merged line from the output already read without waiting
+		if len(self._merged) > 0:
+			entry = self._merged.popleft()
+			self._mergedBytes -= len(entry[2]) + 1
+			return entry
+
+		if not fullLineOnly:
+			for name, pipe in self._streams:
+				if self._partialBytes[name] > 0:
+					line = ''.join(self._partial[name])
+					self._partial[name] = []
+					self._partialBytes[name] = 0
+					self._sequence += 1
+					return (self._sequence, name, line)
+
+		return None
+
+	def readSimple(self, fullLineOnly=True, stream='stdout'):
 		'''Returns a string of all the available output in simplified
 		form. An empty string is returned when no output is available.
 		Returns a string with:
 			- carriage returns removed.
 			- Only full lines
 		'''
-		return self.stdout.readSimple(fullLineOnly)
+		if stream != 'both':
+			return self._pipe(stream).readSimple(fullLineOnly)
+
+		output = self.readLine(fullLineOnly, stream)
+		if output is None:
+			return ''
+
+		return output.translate(None, '\r')
 
 	def sendLine(self, line):
 		'''Send a string to the process, adds a terminating newline'''
 		self.send(line + '\n')
 
+	def _captured(self):
+		if not self.capture:
+			raise ValueError('output is only available in place when the process is started with capture')
+		return self.stdout
+
+	def outputView(self):
+		'''Returns a read-only buffer of everything the process has written to stdout
+		   so far. The data is not copied, it is mapped directly from the capture file.
+		   Requires the process to have been started with capture.
+		'''
+		return self._captured().view()
+
+	def searchOutput(self, regex):
+		'''Search the captured stdout for the regex, either a string or a compiled
+		   pattern, without copying it. Returns the match object or None. Match
+		   positions are offsets into outputView().
+		'''
+		regex = regexCache.compile(regex)
+		m = self._captured().mapping()
+		if m is None:
+			return regex.search('')
+		return regex.search(m)
+
+	def findAllOutput(self, regex):
+		'''Returns an iterator over all the matches of the regex in the captured stdout'''
+		regex = regexCache.compile(regex)
+		m = self._captured().mapping()
+		if m is None:
+			return regex.finditer('')
+		return regex.finditer(m)
+
+	def _takeLine(self, stream, fullLineOnly):
+		# Return the next simplified line from the output already read without
+		# waiting. None if there is no line available.
+		if stream == 'both':
+			entry = self._takeMergedLine(fullLineOnly)
+			if entry is None:
+				return None
+			line = entry[2]
+		else:
+			line = self._pipe(stream)._takeLine(fullLineOnly)
+			if line is None:
+				return None
+
+		return line.translate(None, '\r')
+
+	def _compileRegexes(self, regexes):
+		return [regexCache.compile(regex) for regex in regexes]
+
 	def _checkRegexes(self, regexes, line):
 		for i in range(len(regexes)):
+			regex = regexCache.compile(regexes[i])
 			if _debug and line != '':
-				print 'checking "%s" against "%s"' % (regexes[i], _escapeAscii(line))
-			if re.search(regexes[i], line) is not None:
+				print 'checking "%s" against "%s"' % (regex.pattern, _escapeAscii(line))
+			if regex.search(line) is not None:
 				return i
 		return -1
 
-	def expect(self, regexes, timeout=5):
+	def expect(self, regexes, timeout=5, stream='stdout'):
 		'''Waits for one of the expected regexes to match or the timeout to expire.
 		   Returns an index into the regexes sequence on success. Returns -1 on timeout.
 		   If multiple matches are found then the first one in regexes is returned.
+		   stream is the output to match against, one of 'stdout', 'stderr' or 'both'.
+		   The regexes may be strings or compiled patterns.
 		'''
+		regexes = self._compileRegexes(regexes)
 		startTime = time.time()
 
 		while time.time() - startTime < timeout:
-			line = self.stdout.readSimple()
+			line = self.readSimple(stream=stream)
 			if line is None:
 				continue # No output this time, wait for next time
 			match = self._checkRegexes(regexes, line)
@@ -1266,16 +3067,19 @@ class Process(object):
 				return match
 		return -1
 
-	def expectPrompt(self, regexes, timeout=5):
+	def expectPrompt(self, regexes, timeout=5, stream='stdout'):
 		'''Waits for the expected regex to match or the timeout to
 		   expire. The regex will only be matched against the final
 		   partial line of the output receieved to date.
 		   Returns an index into the regexes sequence on success. Returns -1 on timeout.
+		   stream is the output to match against, one of 'stdout', 'stderr' or 'both'.
+		   The regexes may be strings or compiled patterns.
 		'''
+		regexes = self._compileRegexes(regexes)
 		startTime = time.time()
 
 		while time.time() - startTime < timeout:
-			line = self.stdout.readSimple(fullLineOnly=False)
+			line = self.readSimple(fullLineOnly=False, stream=stream)
 			if line is None:
 				continue # No output this time, wait for next time
 			match = self._checkRegexes(regexes, line)
@@ -1284,19 +3088,608 @@ class Process(object):
 
 		return -1
 
+	def expectScreen(self, regexes, region=None, timeout=5):
+		'''Waits for one of the regexes to match a row of the virtual terminal screen
+		   or the timeout to expire. The process must have been started with a
+		   terminal emulation for pty.
+
+		   region is the tuple (top, left, bottom, right) of the inclusive bounds of
+		   the part of the screen to search, the whole screen by default. Each row of
+		   the region is matched separately, with blank cells as spaces, and a row is
+		   only matched again once it has changed.
+
+		   Returns the tuple (index, (row, col)) with the index into the regexes
+		   sequence and the screen location of the start of the match. If multiple
+		   matches are found then the first one in regexes is returned. Returns
+		   (-1, None) on timeout.
+		'''
+		if self.vty is None:
+			raise ValueError('expectScreen requires a pty with terminal emulation')
+
+		if region is None:
+			region = (0, 0, self.vty.rows() - 1, self.vty.cols() - 1)
+		top, left, bottom, right = region
+		regexes = self._compileRegexes(regexes)
+		deadline = time.time() + timeout
+		checked = -1
+
+		while True:
+			changes = self.vty.changes()
+			rows = [row for row in range(top, bottom + 1) if self.vty.rowChanged(row, checked)]
+			checked = changes
+
+			for i in range(len(regexes)):
+				for row in rows:
+					line = self.vty.row(row, left, right)
+					if _debug:
+						print 'checking "%s" against screen row %d "%s"' % (regexes[i].pattern,
+								row, _escapeAscii(line))
+					match = regexes[i].search(line)
+					if match is not None:
+						return (i, (row, left + match.start()))
+
+			timeLeft = deadline - time.time()
+			if timeLeft <= 0:
+				return (-1, None)
+			self._pump(timeLeft)
+
+class ProcessGroup(object):
+	'''A collection of Processes which are signalled and torn down together.
+
+	   Each child started through the group is the leader of its own process
+	   group so anything it starts in turn is signalled along with it. Waiting
+	   is done for all the children at once, so tearing down many processes
+	   takes a single timeout rather than one per process.
+	'''
+
+	def __init__(self):
+		self.processes = []
+
+	def start(self, command, **kwargs):
+		'''Start a new Process in its own process group and add it to this group.
+		   The arguments are the same as for Process. Returns the new Process.
+		'''
+		kwargs['newProcessGroup'] = True
+		proc = Process(command, **kwargs)
+		self.processes.append(proc)
+		return proc
+
+	def add(self, proc):
+		'''Add an already started Process to this group'''
+		self.processes.append(proc)
+
+	def running(self):
+		'''Returns the list of Processes which haven't been seen to terminate'''
+		return [proc for proc in self.processes if proc.running]
+
+	def sendSignal(self, sig):
+		'''Send the signal to every process in the group'''
+		for proc in self.processes:
+			proc.sendSignal(sig)
+
+	def waitForTermination(self, timeout=5):
+		'''Wait until the timeout for all the children to terminate, reading
+		   their output while waiting. Returns True if every child terminated
+		   before the timeout, False otherwise.
+		'''
+		startTime = time.time()
+		deadline = startTime + timeout
+
+		while True:
+			running = [proc for proc in self.running() if not proc._reap(deadline)]
+			if len(running) == 0:
+				return True
+
+			timeLeft = deadline - time.time()
+			if timeLeft <= 0:
+				return False
+
+			_pumpProcesses(running, timeLeft, watchExit=True)
+
+	def terminate(self, graceful_timeout=0, timeout=5):
+		'''Terminate all the children. If graceful_timeout is greater than zero
+		   they are first sent SIGTERM and given that many seconds to exit before
+		   the remaining ones are killed. Returns the results(), see there.
+		'''
+		if graceful_timeout > 0:
+			# Grandchildren which ignore SIGTERM are killed as each child exits
+			for proc in self.running():
+				proc._killGroupOnExit = True
+			self.sendSignal(signal.SIGTERM)
+			if self.waitForTermination(graceful_timeout):
+				return self.results()
+
+		self.sendSignal(signal.SIGKILL)
+		self.waitForTermination(timeout)
+
+		return self.results()
+
+	def results(self):
+		'''Returns a list with a ProcessResult(process, returncode, runtime) for
+		   every child in the order they were added. The returncode is None for
+		   children which are still running.
+		'''
+		return [ProcessResult(proc, proc.returncode, proc.runtime()) for proc in self.processes]
+
+class ProcessOperation(object):
+	'''Base class of the operations which coroutines yield to wait on an
+	   AsyncProcess. The scheduler calls check() whenever there may be progress.
+	   On its own an operation just waits for its timeout, which lets a
+	   coroutine pause while the output of its process keeps being read.
+	'''
+
+	watchExit = False
+
+	def __init__(self, process, timeout):
+		self.process = process
+		self.deadline = time.time() + timeout
+
+	def check(self):
+		'''Returns the tuple (True, result) once the operation has finished,
+		   (False, None) otherwise. Finishes with None once the timeout has
+		   expired.
+		'''
+		if time.time() >= self.deadline:
+			return True, None
+		return False, None
+
+class ExpectOperation(ProcessOperation):
+	'''Finishes with the index of the first regex to match, or -1 on timeout'''
+
+	def __init__(self, process, regexes, timeout, stream, fullLineOnly):
+		ProcessOperation.__init__(self, process, timeout)
+		self.regexes = process._compileRegexes(regexes)
+		self.stream = stream
+		self.fullLineOnly = fullLineOnly
+
+	def check(self):
+		line = self.process._takeLine(self.stream, self.fullLineOnly)
+		while line is not None:
+			match = self.process._checkRegexes(self.regexes, line)
+			if match != -1:
+				return True, match
+			line = self.process._takeLine(self.stream, self.fullLineOnly)
+
+		if time.time() >= self.deadline:
+			return True, -1
+		return False, None
+
+class SendOperation(ProcessOperation):
+	'''Finishes with True once all the data has been written to the process, or
+	   False on timeout.
+	'''
+
+	def __init__(self, process, data, timeout):
+		ProcessOperation.__init__(self, process, timeout)
+		Process.send(process, data)
+
+	def check(self):
+		if self.process.stdin.pending() == 0:
+			return True, True
+		if time.time() >= self.deadline:
+			return True, False
+		return False, None
+
+class WaitOperation(ProcessOperation):
+	'''Finishes with the returncode of the process, or None on timeout'''
+
+	watchExit = True
+
+	def check(self):
+		if self.process._reap(self.deadline):
+			return True, self.process.returncode
+		if time.time() >= self.deadline:
+			return True, None
+		return False, None
+
+class AsyncProcess(Process):
+	'''A Process for use from generator based coroutines run by runCoroutines().
+	   Instead of blocking, the waiting methods return a ProcessOperation which
+	   the coroutine yields. The coroutine is resumed with the result of the
+	   operation once it finishes:
+
+	       def login(proc):
+	           index = yield proc.expect(['login:'])
+	           yield proc.sendLine('root')
+	           returncode = yield proc.wait()
+
+	   The pipes, pty and Vtty mirroring are the same as for Process. All the
+	   processes of all the coroutines are serviced from a single select loop.
+	'''
+
+	def expect(self, regexes, timeout=5, stream='stdout'):
+		'''Operation which waits for one of the regexes to match a line or the
+		   timeout to expire. See Process.expect().
+		'''
+		return ExpectOperation(self, regexes, timeout, stream, True)
+
+	def expectPrompt(self, regexes, timeout=5, stream='stdout'):
+		'''Operation which waits for one of the regexes to match the final
+		   partial line or the timeout to expire. See Process.expectPrompt().
+		'''
+		return ExpectOperation(self, regexes, timeout, stream, False)
+
+	def send(self, text, timeout=5):
+		'''Operation which sends the characters and waits until the process has
+		   accepted them all.
+		'''
+		return SendOperation(self, text, timeout)
+
+	def sendLine(self, line, timeout=5):
+		'''Operation which sends the line with a terminating newline'''
+		return self.send(line + '\n', timeout)
+
+	def wait(self, timeout=5):
+		'''Operation which waits for the process to terminate'''
+		return WaitOperation(self, timeout)
+
+def runCoroutines(*coroutines):
+	'''Run the generator coroutines concurrently until they have all finished.
+	   Each coroutine yields ProcessOperations and is resumed with their
+	   results. An exception raised by any coroutine is raised from here.
+	'''
+	# Each task is a [coroutine, operation it waits on]. A coroutine which
+	# hasn't started yet, or which yielded None, is resumed immediately.
+	tasks = [[coroutine, None] for coroutine in coroutines]
+	try:
+		while len(tasks) > 0:
+			progress = True
+			while progress:
+				progress = False
+				for task in list(tasks):
+					coroutine, operation = task
+					try:
+						if operation is None:
+							task[1] = coroutine.send(None)
+						elif not isinstance(operation, ProcessOperation):
+							error = TypeError('Coroutines may only yield ProcessOperations, not %r' % (operation,))
+							task[1] = coroutine.throw(error)
+						else:
+							done, result = operation.check()
+							if not done:
+								continue
+							task[1] = coroutine.send(result)
+					except StopIteration:
+						tasks.remove(task)
+					progress = True
+
+			if len(tasks) == 0:
+				break
+
+			processes = []
+			watchExit = False
+			for coroutine, operation in tasks:
+				if operation.process not in processes:
+					processes.append(operation.process)
+				watchExit = watchExit or operation.watchExit
+
+			timeout = max(0, min([operation.deadline for coroutine, operation in tasks]) - time.time())
+			_pumpProcesses(processes, timeout, watchExit)
+	finally:
+		for coroutine, operation in tasks:
+			coroutine.close()
+
+def coroutineTest(method):
+	'''Decorator for TestCase methods written as a coroutine which yields
+	   ProcessOperations, runs the method with runCoroutines().
+	'''
+	@functools.wraps(method)
+	def runner(self, *args, **kwargs):
+		runCoroutines(method(self, *args, **kwargs))
+	return runner
+
 def _readStubMessage(sock):
-	'''Given the socket read the next stub message and return it to be parsed.
+	'''Given the blocking socket read the next stub message and return it to be
+	   parsed. Returns None if the connection is closed first.
 
 	   The message format is simple, first a four byte integer with the
 	   length of the message, then the message itself of that length.
 	'''
-	buf = sock.recv(struct.calcsize(MSG_HEADER_FMT))
+	header_size = struct.calcsize(MSG_HEADER_FMT)
+	buf = _recvExactly(sock, header_size)
+	if len(buf) < header_size:
+		return None
 	size = struct.unpack(MSG_HEADER_FMT, buf)[0]
 
-	msg = sock.recv(size)
+	msg = _recvExactly(sock, size)
+	if len(msg) < size:
+		return None
 	return msg
 
-class Stub(asyncore.dispatcher):
+class FrameDecoder(object):
+	'''Incremental decoder of the stub messages arriving on a non-blocking socket.
+
+	   Everything available is read in one go and as many complete messages as
+	   it contains are returned, with any partial message kept until the rest
+	   arrives. The body of a message which doesn't arrive all at once is
+	   received directly into a buffer of its full size so that large messages
+	   aren't copied repeatedly as they are reassembled.
+	'''
+
+	headerSize = struct.calcsize(MSG_HEADER_FMT)
+	chunkSize = 65536
+
+	def __init__(self):
+		self._chunk = bytearray(self.chunkSize)
+		self._header = bytearray()
+		self._body = None
+		self._filled = 0
+
+	def receive(self, sock):
+		'''Read what is available from the socket. Returns the list of complete
+		   messages received, which may be empty, or None if the far end closed
+		   the connection.
+		'''
+		if self._body is not None:
+			view = memoryview(self._body)[self._filled:]
+			size = sock.recv_into(view)
+			if size == 0:
+				return None
+			self._filled += size
+			if self._filled < len(self._body):
+				return []
+			return [self._finishBody()]
+
+		size = sock.recv_into(self._chunk)
+		if size == 0:
+			return None
+		return self.feed(memoryview(self._chunk)[:size])
+
+	def _finishBody(self):
+		msg = str(self._body)
+		self._body = None
+		self._filled = 0
+		return msg
+
+	def feed(self, data):
+		'''Decode the data, a string or memoryview, and return the list of
+		   complete messages it finishes.
+		'''
+		data = memoryview(data)
+		messages = []
+		offset = 0
+		end = len(data)
+
+		while offset < end:
+			if self._body is not None:
+				count = min(len(self._body) - self._filled, end - offset)
+				self._body[self._filled:self._filled + count] = data[offset:offset + count]
+				self._filled += count
+				offset += count
+				if self._filled == len(self._body):
+					messages.append(self._finishBody())
+				continue
+
+			if len(self._header) == 0 and end - offset >= self.headerSize:
+				size = struct.unpack_from(MSG_HEADER_FMT, data, offset)[0]
+				offset += self.headerSize
+			else:
+				count = min(self.headerSize - len(self._header), end - offset)
+				self._header += data[offset:offset + count]
+				offset += count
+				if len(self._header) < self.headerSize:
+					break
+				size = struct.unpack(MSG_HEADER_FMT, str(self._header))[0]
+				self._header = bytearray()
+
+			if end - offset >= size:
+				# The common case of the whole message being available
+				messages.append(data[offset:offset + size].tobytes())
+				offset += size
+			else:
+				self._body = bytearray(size)
+				self._filled = 0
+
+		return messages
+
+class Reactor(object):
+	'''Dispatches readiness events for many sockets from a single epoll set,
+	   or poll where epoll isn't available.
+
+	   Handlers provide fileno(), handle_read() and handle_write(). They stay
+	   registered for reading until unregistered, so the set of descriptors is
+	   never rebuilt. Interest in writing is switched on with wantWrite(), from
+	   any thread, and off again with doneWriting() once there is nothing left
+	   to send. The cost of each event is therefore independent of how many
+	   connections are open.
+
+	   thread is the thread which will call poll(), by default the first one
+	   to do so. Handlers registered or unregistered from any other thread
+	   are handed over to it so the set of descriptors is only ever changed
+	   by the thread polling it.
+	'''
+
+	READ = select.POLLIN | select.POLLPRI | select.POLLERR | select.POLLHUP
+	WRITE = select.POLLOUT
+
+	def __init__(self, thread=None):
+		if hasattr(select, 'epoll'):
+			self._poller = select.epoll()
+			self._timeoutScale = 1
+		else:
+			self._poller = select.poll()
+			self._timeoutScale = 1000
+		self._handlers = {} # fd -> handler
+		self._fds = {} # handler -> fd, the socket may be closed before unregistering
+		self._lock = threading.Lock()
+		self._pending = set() # handlers waiting to have write interest added
+		self._calls = [] # (function, handler, result) to run in the polling thread
+		self._closed = False
+		self._thread = thread
+
+		self._wakeup_r, self._wakeup_w = os.pipe()
+		for fd in (self._wakeup_r, self._wakeup_w):
+			flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+			fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+			flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+			fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+		self._poller.register(self._wakeup_r, self.READ)
+
+	def register(self, handler):
+		'''Start dispatching events for the handler. handler.reactor is set to
+		   this reactor.
+		'''
+		handler.reactor = self
+		self._inThread(self._register, handler)
+
+	def _register(self, handler):
+		if self._closed:
+			raise ValueError('Reactor is closed')
+		fd = handler.fileno()
+		self._handlers[fd] = handler
+		self._fds[handler] = fd
+		self._poller.register(fd, self.READ)
+
+	def unregister(self, handler):
+		'''Stop dispatching events for the handler, if it is registered'''
+		self._inThread(self._unregister, handler)
+
+	def _unregister(self, handler):
+		fd = self._fds.pop(handler, None)
+		if fd is not None and self._handlers.get(fd) is handler:
+			del self._handlers[fd]
+			if not self._closed:
+				self._poller.unregister(fd)
+
+	def _inThread(self, function, handler):
+		# Call function(handler) in the polling thread and wait for it to
+		# finish, raising anything it raised. It is called directly when
+		# nothing is polling. Calls still queued when the reactor is
+		# closed are run by close().
+		thread = self._thread
+		if thread is None or thread is threading.current_thread() or not thread.is_alive():
+			function(handler)
+			return
+
+		result = [threading.Event(), None]
+		with self._lock:
+			closed = self._closed
+			if not closed:
+				self._calls.append((function, handler, result))
+		if closed:
+			function(handler)
+			return
+		self.wake()
+		result[0].wait()
+		if result[1] is not None:
+			raise result[1]
+
+	def _runCalls(self, closing=False):
+		with self._lock:
+			calls, self._calls = self._calls, []
+			if closing:
+				self._closed = True
+		for function, handler, result in calls:
+			try:
+				function(handler)
+			except Exception as e:
+				result[1] = e
+			result[0].set()
+
+	def wantWrite(self, handler):
+		'''Dispatch handle_write() to the handler whenever it may write without
+		   blocking, until doneWriting() is called.
+		'''
+		if threading.current_thread() is self._thread:
+			self._modify(handler, self.READ | self.WRITE)
+			return
+
+		with self._lock:
+			if handler in self._pending:
+				return
+			self._pending.add(handler)
+		self.wake()
+
+	def doneWriting(self, handler):
+		'''Stop dispatching handle_write() to the handler'''
+		self._modify(handler, self.READ)
+
+	def _modify(self, handler, events):
+		fd = self._fds.get(handler)
+		if fd is not None and self._handlers.get(fd) is handler:
+			self._poller.modify(fd, events)
+
+	def wake(self):
+		'''Cause a poll() in progress in another thread to return'''
+		try:
+			os.write(self._wakeup_w, 'w')
+		except OSError as e:
+			if e.errno != errno.EAGAIN:
+				raise
+
+	def poll(self, timeout=None):
+		'''Wait up to timeout seconds, forever if None, for any of the handlers to
+		   be ready and dispatch the events.
+		'''
+		if self._thread is None:
+			self._thread = threading.current_thread()
+
+		self._runCalls()
+		with self._lock:
+			pending, self._pending = self._pending, set()
+		for handler in pending:
+			self._modify(handler, self.READ | self.WRITE)
+
+		if timeout is None:
+			timeout = -1
+		else:
+			timeout *= self._timeoutScale
+
+		try:
+			events = self._poller.poll(timeout)
+		except (IOError, select.error) as e:
+			if e.args[0] == errno.EINTR:
+				return
+			raise
+
+		for fd, mask in events:
+			if fd == self._wakeup_r:
+				try:
+					os.read(self._wakeup_r, 4096)
+				except OSError:
+					pass
+				continue
+
+			handler = self._handlers.get(fd)
+			if handler is None:
+				continue
+			try:
+				if mask & self.READ:
+					handler.handle_read()
+				if mask & self.WRITE and self._handlers.get(fd) is handler:
+					handler.handle_write()
+			except Exception:
+				traceback.print_exc()
+				handler.close()
+
+	def close(self):
+		self._runCalls(closing=True)
+		self._poller.close()
+		os.close(self._wakeup_r)
+		os.close(self._wakeup_w)
+
+class _StubReadReady(object):
+	'''Event-like view of whether a stub has received messages waiting to
+	   be read, kept for code which waits on Stub.read_ready.
+	'''
+	def __init__(self, stub):
+		self._stub = stub
+
+	def is_set(self):
+		return len(self._stub.in_buf) > 0
+
+	isSet = is_set
+
+	def wait(self, timeout=None):
+		stub = self._stub
+		with stub.received:
+			if timeout is None:
+				while len(stub.in_buf) == 0:
+					stub.received.wait()
+				return True
+			return stub._waitFor(self.is_set, timeout)
+
+class Stub(object):
 	'''This is the base class of the Stub objects. It is intended that a
 	   user will subclass this to add the methods they wish to stub out
 	   with the logic to do so.
@@ -1305,73 +3698,141 @@ class Stub(asyncore.dispatcher):
 	   as part of __init__, self.type to the string you intend to
 	   register this class for.
 	'''
-	in_buf = None
-	out_buf = None
-	read_ready = None # Is there data to be read
+	in_buf = None # Received messages waiting to be read
+	out_buf = None # Headers and messages waiting to be sent
+	received = None # Notified whenever a message is added to in_buf
 	write_done = None # There is no more data to write
 	lock = None
+	reactor = None
+	id = None # The id the far end registered with
+	types = () # The types this stub can be found by with StubCentral.waitForStub()
 	_disconnect = False
 
-	def __init__(self, sock=None, map=None):
-		asyncore.dispatcher.__init__(self, sock, map)
-		self.read_ready = threading.Event()
+	# Queued data is sent in batches of up to this many bytes
+	batchSize = 65536
+
+	def __init__(self, sock=None):
+		self.socket = sock
+		if sock is not None:
+			sock.setblocking(0)
+		self.connected = sock is not None
 		self.write_done = threading.Event()
+		self.write_done.set()
 		self.lock = threading.Lock()
-		self.in_buf = []
-		self.out_buf = []
+		self.received = threading.Condition(self.lock)
+		self.in_buf = collections.deque()
+		self.out_buf = collections.deque()
+		self._outOffset = 0 # How much of out_buf[0] has already been sent
+		self._decoder = FrameDecoder()
 
-	def writable(self):
-		if len(self.out_buf) > 0:
-			return True
-		else:
-			if self._disconnect:
-				self.del_channel()
-				self.close()
+	def fileno(self):
+		return self.socket.fileno()
 
+	def close(self):
+		'''Close the connection to the far end stub'''
+		if not self.connected:
+			return
+		self.connected = False
+		if self.reactor is not None:
+			self.reactor.unregister(self)
+		self.socket.close()
+
+	def send(self, data):
+		'''Send as much of data as possible without blocking and return how
+		   much was sent.
+		'''
+		try:
+			return self.socket.send(data)
+		except socket.error as e:
+			if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				return 0
+			if e.args[0] in (errno.ECONNRESET, errno.EPIPE, errno.ENOTCONN, errno.ESHUTDOWN):
+				self.close()
+				return 0
+			raise
+
+	def _writeDone(self):
+		self.reactor.doneWriting(self)
+		# Checked under the lock so a concurrent write() either queues
+		# before the check or clears write_done after it is set
+		with self.lock:
+			if len(self.out_buf) > 0:
+				# More was queued meanwhile, write interest has been requested again
+				return
 			self.write_done.set()
-			return False
-
-	def readable(self):
-		return not self._disconnect
+			disconnect = self._disconnect
+		if disconnect:
+			self.close()
 
 	def handle_write(self):
 		if len(self.out_buf) == 0:
-				return
+			self._writeDone()
+			return
+
+		# Small headers and messages are joined together to be sent with a
+		# single call, large messages are sent in place without copying.
+		first = self.out_buf[0]
+		if len(first) - self._outOffset >= self.batchSize:
+			data = buffer(first, self._outOffset)
+		else:
+			pieces = [first[self._outOffset:]]
+			size = len(pieces[0])
+			for i in range(1, len(self.out_buf)):
+				piece = self.out_buf[i]
+				if size + len(piece) > self.batchSize:
+					break
+				pieces.append(piece)
+				size += len(piece)
+			data = ''.join(pieces)
+
+		bytes_sent = self.send(data)
 
 		if _debug:
-			print 'Stub sending message "%s"' % _escapeAscii(self.out_buf[0])
+			print 'Stub sent %d of %d queued bytes' % (bytes_sent, len(data))
 
-		self.send(struct.pack(MSG_HEADER_FMT, len(self.out_buf[0])))
-		bytes_sent = self.send(self.out_buf[0])
-		if bytes_sent == len(self.out_buf[0]):
-			del self.out_buf[0]
-		else:
-			self.out_buf[0] = self.out_buf[0][bytes_sent:]
+		bytes_sent += self._outOffset
+		while self.out_buf and bytes_sent >= len(self.out_buf[0]):
+			bytes_sent -= len(self.out_buf.popleft())
+		self._outOffset = bytes_sent
+
+		if len(self.out_buf) == 0:
+			self._writeDone()
 
 	def handle_read(self):
-		ready = self.socket.recv(100, socket.MSG_PEEK)
-		if len(ready) < 4:
-			# Not enough data to decode yet, wait a bit
-			if not ready:
-				# socket was closed by the other end
-				self.close()
+		try:
+			messages = self._decoder.receive(self.socket)
+		except socket.error as e:
+			if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				return
+			if e.args[0] not in (errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN):
+				raise
+			messages = None
+
+		if messages is None:
+			# socket was closed by the other end
+			self.close()
 			return
 
-		self.lock.acquire()
-		msg = _readStubMessage(self.socket)
+		self._received(messages)
 
-		if _debug:
-			print 'Stub received message "%s"' % msg
+	def _received(self, messages):
+		unconsumed = []
+		for msg in messages:
+			if _debug:
+				print 'Stub received message "%s"' % msg
 
-		if not self.consume_read(msg):
-			self.in_buf.append(msg)
-			self.read_ready.set()
+			if not self.consume_read(msg):
+				unconsumed.append(msg)
 
-		self.lock.release()
+		if len(unconsumed) > 0:
+			with self.received:
+				self.in_buf.extend(unconsumed)
+				self.received.notify_all()
 
 	def disconnect(self):
+		'''Close the connection once everything queued has been sent'''
 		self._disconnect = True
-		self.stubcentral.trigger()
+		self.reactor.wantWrite(self)
 
 	def consume_read(self, msg):
 		'''This method is called when a message has been received. If
@@ -1386,23 +3847,74 @@ class Stub(asyncore.dispatcher):
 		'''
 		return False
 
+	@property
+	def read_ready(self):
+		'''An Event-like object which is set while there are received
+		   messages waiting to be read.
+		'''
+		return _StubReadReady(self)
+
+	def _waitFor(self, ready, timeout):
+		# Wait with the lock held until ready() is true or the timeout has
+		# elapsed. Returns the final value of ready().
+		end = time.time() + timeout
+		while not ready():
+			remaining = end - time.time()
+			if remaining <= 0:
+				break
+			self.received.wait(remaining)
+		return ready()
+
 	def read(self, timeout=5):
 		'''Read the next message sent by the far side of the stub.
 		Returns an empty string if nothing was received.
 		'''
-		self.read_ready.wait(timeout)
-		self.lock.acquire()
-
-		if len(self.in_buf) == 0:
-			self.lock.release()
-			return ''
-
-		buf = self.in_buf[0]
-		del self.in_buf[0]
-		self.read_ready.clear()
-		self.lock.release()
-
-		return buf
+		with self.received:
+			if not self._waitFor(lambda: len(self.in_buf) > 0, timeout):
+				return ''
+			return self.in_buf.popleft()
+
+	def readMany(self, count, timeout=5):
+		'''Read up to count messages sent by the far side of the stub. Waits
+		   until the timeout for the first message and then returns as many
+		   as have already been received, in order, as a list. Returns an
+		   empty list if nothing was received.
+		'''
+		with self.received:
+			self._waitFor(lambda: len(self.in_buf) > 0, timeout)
+			count = min(count, len(self.in_buf))
+			return [self.in_buf.popleft() for i in xrange(count)]
+
+	def readAll(self, timeout=5):
+		'''Read every message which has been received from the far side of
+		   the stub, waiting until the timeout for the first if there are none
+		   yet. Returns a possibly empty list.
+		'''
+		with self.received:
+			self._waitFor(lambda: len(self.in_buf) > 0, timeout)
+			messages = list(self.in_buf)
+			self.in_buf.clear()
+			return messages
+
+	def readUntil(self, predicate, timeout=5):
+		'''Read messages up to and including the first for which
+		   predicate(msg) is true, waiting until the timeout for it to arrive.
+		   Returns the list of messages, or an empty list, leaving everything
+		   queued, if no such message arrived in time.
+		'''
+		# Each message is only tested once however many times we wake up
+		scan = [0, None]
+		def found():
+			while scan[1] is None and scan[0] < len(self.in_buf):
+				if predicate(self.in_buf[scan[0]]):
+					scan[1] = scan[0]
+				scan[0] += 1
+			return scan[1] is not None
+
+		with self.received:
+			if not self._waitFor(found, timeout):
+				return []
+			return [self.in_buf.popleft() for i in xrange(scan[1] + 1)]
 
 	def write(self, msg):
 		'''Add the given message to be sent to the far side stub
@@ -1410,9 +3922,15 @@ class Stub(asyncore.dispatcher):
 		'''
 		if _debug:
 			print 'Stub adding message to write queue "%s"' % _escapeAscii(msg)
-		self.out_buf.append(msg)
-		self.write_done.clear()
-		self.stubcentral.trigger()
+		header = struct.pack(MSG_HEADER_FMT, len(msg))
+		with self.lock:
+			self.write_done.clear()
+			if len(msg) < self.batchSize:
+				self.out_buf.append(header + msg)
+			else:
+				# Large messages are queued separately to be sent without copying
+				self.out_buf.extend((header, msg))
+		self.reactor.wantWrite(self)
 
 	def flush(self, timeout=5):
 		'''Wait until the write queue is empty or the timeout has elapsed.
@@ -1432,6 +3950,657 @@ class SimpleStub(Stub):
 	   '''
 	type = 'SimpleStub'
 
+# Kinds of RpcStub message
+RPC_REQUEST = 0
+RPC_RESPONSE = 1
+RPC_ERROR = 2
+RPC_HEADER_FMT = '!BL' # kind, call id
+
+def encodeRpcValue(value):
+	'''Encode the value for an RpcStub message. Each value is a one byte tag
+	   followed by its data, all integers in network byte order:
+	     N - None
+	     T - True
+	     F - False
+	     i - 64 bit signed integer
+	     d - 64 bit IEEE double
+	     s - byte string, 32 bit length then the bytes
+	     u - unicode string, as s with the UTF-8 encoding
+	     l - list or tuple, 32 bit count then the values
+	     m - dictionary, 32 bit count then alternating keys and values
+	'''
+	parts = []
+	_encodeRpcValue(value, parts)
+	return ''.join(parts)
+
+def _encodeRpcValue(value, parts):
+	if value is None:
+		parts.append('N')
+	elif value is True:
+		parts.append('T')
+	elif value is False:
+		parts.append('F')
+	elif isinstance(value, (int, long)):
+		parts.append(struct.pack('!cq', 'i', value))
+	elif isinstance(value, float):
+		parts.append(struct.pack('!cd', 'd', value))
+	elif isinstance(value, str):
+		parts.append(struct.pack('!cL', 's', len(value)))
+		parts.append(value)
+	elif isinstance(value, unicode):
+		value = value.encode('utf-8')
+		parts.append(struct.pack('!cL', 'u', len(value)))
+		parts.append(value)
+	elif isinstance(value, (list, tuple)):
+		parts.append(struct.pack('!cL', 'l', len(value)))
+		for item in value:
+			_encodeRpcValue(item, parts)
+	elif isinstance(value, dict):
+		parts.append(struct.pack('!cL', 'm', len(value)))
+		for key, item in value.items():
+			_encodeRpcValue(key, parts)
+			_encodeRpcValue(item, parts)
+	else:
+		raise TypeError('%s cannot be encoded for an RPC' % type(value).__name__)
+
+def decodeRpcValue(data, offset=0):
+	'''Decode the value encoded by encodeRpcValue() which starts at offset in data.
+	   Returns the tuple (value, offset just past the value).
+	'''
+	tag = data[offset]
+	offset += 1
+	if tag == 'N':
+		return None, offset
+	elif tag == 'T':
+		return True, offset
+	elif tag == 'F':
+		return False, offset
+	elif tag == 'i':
+		return struct.unpack_from('!q', data, offset)[0], offset + 8
+	elif tag == 'd':
+		return struct.unpack_from('!d', data, offset)[0], offset + 8
+	elif tag in 'suml':
+		count = struct.unpack_from('!L', data, offset)[0]
+		offset += 4
+		if tag == 's':
+			return data[offset:offset + count], offset + count
+		elif tag == 'u':
+			return data[offset:offset + count].decode('utf-8'), offset + count
+		elif tag == 'l':
+			items = []
+			for i in range(count):
+				item, offset = decodeRpcValue(data, offset)
+				items.append(item)
+			return items, offset
+		else:
+			items = {}
+			for i in range(count):
+				key, offset = decodeRpcValue(data, offset)
+				items[key], offset = decodeRpcValue(data, offset)
+			return items, offset
+	raise ValueError('Unknown RPC value tag %r' % tag)
+
+def encodeRpcMessage(kind, id, *values):
+	'''Encode an RpcStub message. Requests carry the method name and the list of
+	   arguments, responses the result and errors the error message.
+	'''
+	return struct.pack(RPC_HEADER_FMT, kind, id) + ''.join([encodeRpcValue(value) for value in values])
+
+def decodeRpcMessage(msg):
+	'''Decode an RpcStub message. Returns the tuple (kind, id, values)'''
+	kind, id = struct.unpack_from(RPC_HEADER_FMT, msg)
+	offset = struct.calcsize(RPC_HEADER_FMT)
+	values = []
+	while offset < len(msg):
+		value, offset = decodeRpcValue(msg, offset)
+		values.append(value)
+	return kind, id, values
+
+class RpcError(Exception):
+	'''An RPC failed, either at the far end or because no response arrived'''
+	pass
+
+class RpcFuture(object):
+	'''The eventual result of a call made with RpcStub.call()'''
+
+	def __init__(self, id, method):
+		self.id = id
+		self.method = method
+		self._done = threading.Event()
+		self._value = None
+		self._error = None
+
+	def done(self):
+		'''Returns True once the response has arrived'''
+		return self._done.is_set()
+
+	def result(self, timeout=5):
+		'''Wait until the timeout for the response and return the result. Raises
+		   RpcError if the far end reported an error or didn't respond in time.
+		'''
+		if not self._done.wait(timeout):
+			raise RpcError('No response to %s (call %d) within %ss' % (self.method, self.id, timeout))
+		if self._error is not None:
+			raise RpcError(self._error)
+		return self._value
+
+	def _resolve(self, value=None, error=None):
+		self._value = value
+		self._error = error
+		self._done.set()
+
+class RpcCall(object):
+	'''A call made by the far end of an RpcStub which is waiting for an answer.
+	   Calls may be answered in any order.
+	'''
+
+	def __init__(self, stub, id, method, args):
+		self.stub = stub
+		self.id = id
+		self.method = method
+		self.args = args
+
+	def reply(self, value=None):
+		'''Answer the call with the result value'''
+		self.stub.write(encodeRpcMessage(RPC_RESPONSE, self.id, value))
+
+	def fail(self, message):
+		'''Answer the call with an error'''
+		self.stub.write(encodeRpcMessage(RPC_ERROR, self.id, message))
+
+class RpcStub(Stub):
+	'''A Stub which exchanges remote procedure calls with the far end. Every
+	   message carries a call id so that any number of calls may be outstanding
+	   in either direction and answered out of order. The messages are encoded
+	   with encodeRpcMessage().
+
+	   Calls from the far end are answered by the handler registered for the
+	   method with handle(), if there is one, otherwise they are queued to be
+	   collected with nextCall() and answered by the test. Calls to the far
+	   end are made with call() which returns an RpcFuture.
+
+	   Register the class with StubCentral.add_class() under the type the far
+	   end uses.
+	'''
+	type = 'RpcStub'
+
+	def __init__(self, sock=None):
+		Stub.__init__(self, sock)
+		self._handlers = {}
+		self._futures = {}
+		self._futuresLock = threading.Lock()
+		self._ids = itertools.count(1)
+
+	def handle(self, method, handler):
+		'''Answer calls of method from the far end with the result of calling
+		   handler with their arguments. The handler is called from the
+		   StubCentral thread and any exception it raises is returned as an
+		   error.
+		'''
+		self._handlers[method] = handler
+
+	def call(self, method, *args):
+		'''Call method at the far end with args. Returns an RpcFuture for the result.'''
+		with self._futuresLock:
+			id = next(self._ids)
+			future = RpcFuture(id, method)
+			self._futures[id] = future
+		self.write(encodeRpcMessage(RPC_REQUEST, id, method, list(args)))
+		return future
+
+	def nextCall(self, timeout=5):
+		'''Wait until the timeout for a call from the far end which has no handler.
+		   Returns an RpcCall or None if no call arrived in time.
+		'''
+		msg = self.read(timeout)
+		if msg == '':
+			return None
+		kind, id, values = decodeRpcMessage(msg)
+		return RpcCall(self, id, values[0], values[1])
+
+	def consume_read(self, msg):
+		kind, id, values = decodeRpcMessage(msg)
+
+		if kind == RPC_REQUEST:
+			method, args = values
+			if method not in self._handlers:
+				return False
+			call = RpcCall(self, id, method, args)
+			try:
+				call.reply(self._handlers[method](*args))
+			except Exception as e:
+				call.fail('%s: %s' % (type(e).__name__, e))
+			return True
+
+		with self._futuresLock:
+			future = self._futures.pop(id, None)
+		if future is None:
+			print 'Error: RPC response to unknown call %d' % id
+		elif kind == RPC_RESPONSE:
+			future._resolve(value=values[0])
+		else:
+			future._resolve(error=values[0])
+		return True
+
+	def close(self):
+		Stub.close(self)
+
+		# Nothing more will be answered
+		with self._futuresLock:
+			futures, self._futures = self._futures, {}
+		for future in futures.values():
+			future._resolve(error='Stub disconnected')
+
+# Kinds of BulkStub message, the first byte of each message
+BULK_INLINE = 'M' # The rest of the message is the payload
+BULK_RING = 'R' # BULK_RING_FMT then the name of the sender's ring
+BULK_PAYLOAD = 'P' # BULK_PAYLOAD_FMT locating the payload in the sender's ring
+BULK_FREED = 'F' # BULK_FREED_FMT, the receiver is done with the ring up to there
+BULK_RING_FMT = '!L' # size
+BULK_PAYLOAD_FMT = '!QL' # position, length
+BULK_FREED_FMT = '!Q' # position
+
+SHM_DIR = '/dev/shm'
+BULK_RING_NAME = re.compile(r'/lousy-bulk-[0-9]+-[0-9]+\Z')
+
+_bulkRingIds = itertools.count()
+
+class BulkRing(object):
+	'''A ring buffer in POSIX shared memory which carries the large payloads of
+	   a BulkStub or BulkStubClient in one direction. The sender creates the
+	   ring by giving only its size and the receiver maps the same ring by
+	   name.
+
+	   Positions in the ring only ever increase, the payload at a position is
+	   stored at position modulo size. A payload is never split across the end
+	   of the ring, the space left at the end is skipped instead. The sender
+	   only reuses space once the receiver has said it is free.
+	'''
+
+	def __init__(self, size, name=None):
+		self.size = size
+		self.owner = name is None
+		self._head = 0 # Where the next payload goes
+		self._tail = 0 # Everything before here has been freed
+
+		if self.owner:
+			self.name = '/lousy-bulk-%d-%d' % (os.getpid(), next(_bulkRingIds))
+			fd = os.open(SHM_DIR + self.name, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0600)
+			try:
+				os.ftruncate(fd, size)
+				self._map = mmap.mmap(fd, size)
+			finally:
+				os.close(fd)
+		else:
+			# The name comes from the far end, so make sure it can only
+			# refer to a ring in SHM_DIR
+			if BULK_RING_NAME.match(name) is None:
+				raise ValueError('Invalid bulk ring name "%s"' % _escapeAscii(name))
+			if size <= 0:
+				raise ValueError('Invalid bulk ring size %d' % size)
+			self.name = name
+			fd = os.open(SHM_DIR + name, os.O_RDONLY | os.O_NOFOLLOW)
+			try:
+				if os.fstat(fd).st_size < size:
+					raise ValueError('Bulk ring "%s" is smaller than %d bytes' % (name, size))
+				self._map = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+			finally:
+				os.close(fd)
+			# Nothing else needs to find it now, both ends have it mapped
+			self.unlink()
+
+	def put(self, data):
+		'''Copy data into the ring and return its position, or None if there is
+		   not enough free space.
+		'''
+		length = len(data)
+		position = self._head
+		offset = position % self.size
+		if offset + length > self.size:
+			position += self.size - offset
+			offset = 0
+		if position + length - self._tail > self.size:
+			return None
+
+		self._map[offset:offset + length] = data
+		self._head = position + length
+		return position
+
+	def free(self, position):
+		'''Allow the space before position to be reused'''
+		self._tail = max(self._tail, position)
+
+	def contains(self, position, length):
+		'''Returns whether a payload of length bytes at position lies within the
+		   ring without wrapping around its end.
+		'''
+		return length <= self.size and position % self.size + length <= self.size
+
+	def view(self, position, length):
+		'''Return a read only buffer of the payload at position, without copying'''
+		return buffer(self._map, position % self.size, length)
+
+	def unlink(self):
+		try:
+			os.unlink(SHM_DIR + self.name)
+		except OSError as e:
+			if e.errno != errno.ENOENT:
+				raise
+
+	def close(self):
+		if self.owner:
+			self.unlink()
+		self._map.close()
+
+class BulkPayload(object):
+	'''A message received over a bulk channel. Large payloads are left in the
+	   shared memory ring until release() is called, view() gives access to
+	   them without copying. Small payloads, sent inline in the message, need
+	   no releasing but support the same methods.
+	'''
+
+	def __init__(self, data=None, channel=None, position=None, length=None):
+		self._data = data
+		self._channel = channel
+		self.position = position
+		self.end = None
+		self.released = channel is None
+		if channel is not None:
+			self.end = position + length
+			self._length = length
+		else:
+			self._length = len(data)
+
+	def __len__(self):
+		return self._length
+
+	def view(self):
+		'''Return a read only buffer of the payload'''
+		if self._data is not None:
+			return buffer(self._data)
+		if self.released:
+			raise ValueError('Bulk payload has been released')
+		ring = self._channel._inbound
+		if ring is None:
+			raise ValueError('Bulk channel has been closed')
+		return ring.view(self.position, self._length)
+
+	def tobytes(self):
+		'''Return a copy of the payload as a string'''
+		return str(self.view())
+
+	def release(self):
+		'''Let the sender reuse the space of the payload. The view must not be used
+		   afterwards. Payloads may be released in any order.
+		'''
+		if not self.released:
+			self.released = True
+			self._channel._release(self)
+
+class BulkChannel(object):
+	'''The protocol shared by both ends of a bulk stub connection, see BulkStub.
+	   send is called with each message to go to the far end.
+	'''
+
+	def __init__(self, send, ringSize, threshold):
+		self._send = send
+		self.ringSize = ringSize
+		self.threshold = threshold
+		self._outbound = None
+		self._inbound = None
+		self._lock = threading.Lock()
+		self._received = collections.deque() # Payloads in the order received
+
+	def send(self, msg):
+		'''Send msg to the far end, through the ring if it is large'''
+		if len(msg) >= self.threshold:
+			with self._lock:
+				if self._outbound is None and os.path.isdir(SHM_DIR):
+					self._outbound = BulkRing(self.ringSize)
+					self._send(BULK_RING + struct.pack(BULK_RING_FMT, self.ringSize) +
+							self._outbound.name)
+				if self._outbound is not None:
+					position = self._outbound.put(msg)
+					if position is not None:
+						self._send(BULK_PAYLOAD +
+								struct.pack(BULK_PAYLOAD_FMT, position, len(msg)))
+						return
+
+		# Small payloads, or those which don't fit in the ring right now, are
+		# sent in the message itself
+		self._send(BULK_INLINE + msg)
+
+	def decode(self, msg):
+		'''Interpret a message from the far end. Returns the BulkPayload it
+		   carried or None if it was only for the channel. Raises ValueError if
+		   the message breaks the protocol.
+		'''
+		kind = msg[:1]
+		if kind == BULK_INLINE:
+			return BulkPayload(data=msg[1:])
+		elif kind == BULK_PAYLOAD:
+			position, length = struct.unpack_from(BULK_PAYLOAD_FMT, msg, 1)
+			if self._inbound is None:
+				raise ValueError('Bulk payload received before its ring')
+			if not self._inbound.contains(position, length):
+				raise ValueError('Bulk payload of %d bytes at %d is outside the ring' %
+						(length, position))
+			payload = BulkPayload(channel=self, position=position, length=length)
+			with self._lock:
+				self._received.append(payload)
+			return payload
+		elif kind == BULK_FREED:
+			position, = struct.unpack_from(BULK_FREED_FMT, msg, 1)
+			with self._lock:
+				if self._outbound is not None:
+					self._outbound.free(position)
+		elif kind == BULK_RING:
+			size, = struct.unpack_from(BULK_RING_FMT, msg, 1)
+			name = msg[1 + struct.calcsize(BULK_RING_FMT):]
+			if self._inbound is not None:
+				raise ValueError('Bulk ring received twice')
+			self._inbound = BulkRing(size, name)
+		else:
+			print 'Error: Unknown bulk message kind "%s"' % _escapeAscii(kind)
+		return None
+
+	def _release(self, payload):
+		# The sender frees in order, so only tell it once every payload
+		# before this one has been released as well
+		end = None
+		with self._lock:
+			while len(self._received) > 0 and self._received[0].released:
+				end = self._received.popleft().end
+		if end is not None:
+			self._send(BULK_FREED + struct.pack(BULK_FREED_FMT, end))
+
+	def close(self):
+		with self._lock:
+			for ring in (self._outbound, self._inbound):
+				if ring is not None:
+					ring.close()
+			self._outbound = None
+			self._inbound = None
+
+class BulkStub(Stub):
+	'''A Stub for exchanging large binary payloads, such as image frames or
+	   packet captures. Payloads of at least bulkThreshold bytes are copied
+	   once into a ring of ringSize bytes in shared memory and only their
+	   location is sent over the socket. Smaller payloads are sent in the
+	   message as usual. Both ends must be on the same machine, the far end
+	   uses BulkStubClient or implements the same protocol:
+
+	   Every message starts with a byte giving its kind:
+	     M - the rest of the message is the payload
+	     R - a 32 bit ring size then the name of a new POSIX shared memory
+	         object, which the sender's large payloads will be placed in
+	     P - a 64 bit position and 32 bit length of a payload in the sender's
+	         ring, at position modulo the ring size
+	     F - a 64 bit position before which the sender of this message has
+	         finished with the receiver's ring
+	   All integers are in network byte order.
+
+	   read() returns a copy of the next payload. readPayload() returns a
+	   BulkPayload which can be examined in place and must be released. The
+	   batch reads of Stub return a BulkPayload for every message, whether it
+	   was sent through the ring or inline.
+
+	   A message which breaks the protocol closes the connection.
+	'''
+	type = 'BulkStub'
+
+	ringSize = 16 * 1024 * 1024
+	bulkThreshold = 65536
+
+	def __init__(self, sock=None):
+		Stub.__init__(self, sock)
+		self.channel = BulkChannel(functools.partial(Stub.write, self),
+				self.ringSize, self.bulkThreshold)
+
+	def _received(self, messages):
+		try:
+			payloads = [self.channel.decode(msg) for msg in messages]
+		except (ValueError, OSError, struct.error) as e:
+			print 'Error: Closing bulk stub "%s": %s' % (self.id, e)
+			self.close()
+			return
+		Stub._received(self, [payload for payload in payloads if payload is not None])
+
+	def write(self, msg):
+		'''Send msg to the far side stub as soon as possible'''
+		self.channel.send(msg)
+
+	def read(self, timeout=5):
+		'''Read a copy of the next payload sent by the far side of the stub.
+		   Returns an empty string if nothing was received.
+		'''
+		payload = Stub.read(self, timeout)
+		if payload == '':
+			return ''
+		data = payload.tobytes()
+		payload.release()
+		return data
+
+	def readPayload(self, timeout=5):
+		'''Return the next BulkPayload sent by the far side of the stub, or None
+		   if nothing was received before the timeout.
+		'''
+		payloads = self.readMany(1, timeout)
+		if len(payloads) == 0:
+			return None
+		return payloads[0]
+
+	def close(self):
+		Stub.close(self)
+		self.channel.close()
+
+class StubClient(object):
+	'''The far end of a stub connection as the program being tested would use
+	   it. This is useful for driving Stubs from Python and as a reference for
+	   implementing the protocol in other languages.
+
+	   The client connects to StubCentral on the TCP port, the UNIX domain
+	   socket path or over the already connected socket sock, and registers
+	   itself as a stub of the given type and id. If none are given it uses
+	   what a process started with Process(stub=...) is passed in its
+	   environment, otherwise the port this instance of lousy is using.
+	'''
+
+	def __init__(self, type, id, port=None, host='localhost', path=None, sock=None):
+		if port is None and path is None and sock is None:
+			if STUB_FD_ENV in os.environ:
+				# The descriptor can only be used once, so it mustn't be
+				# found again or passed on to our own children
+				fd = int(os.environ.pop(STUB_FD_ENV))
+				sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+				os.close(fd)
+			elif STUB_PATH_ENV in os.environ:
+				path = os.environ[STUB_PATH_ENV]
+			elif STUB_PORT_ENV in os.environ:
+				port = int(os.environ[STUB_PORT_ENV])
+			else:
+				port = stubs.port()
+
+		if sock is not None:
+			self.socket = sock
+		elif path is not None:
+			self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.socket.connect(path)
+		else:
+			self.socket = socket.create_connection((host, port))
+			self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		self._sendFrame('%s,%s' % (type, id))
+
+	def _sendFrame(self, msg):
+		self.socket.sendall(struct.pack(MSG_HEADER_FMT, len(msg)) + msg)
+
+	def _recvFrame(self):
+		return _readStubMessage(self.socket)
+
+	def send(self, msg):
+		'''Send the message to the Stub'''
+		self._sendFrame(msg)
+
+	def recv(self):
+		'''Wait for the next message from the Stub and return it. Returns None if
+		   the Stub has disconnected.
+		'''
+		return self._recvFrame()
+
+	def close(self):
+		self.socket.close()
+
+class BulkStubClient(StubClient):
+	'''The far end of a BulkStub. See StubClient for the arguments.'''
+
+	def __init__(self, type, id, ringSize=BulkStub.ringSize,
+			bulkThreshold=BulkStub.bulkThreshold, **kwargs):
+		self.channel = BulkChannel(self._sendFrame, ringSize, bulkThreshold)
+		self._payloads = collections.deque() # Received while looking for freed space
+		StubClient.__init__(self, type, id, **kwargs)
+
+	def _receive(self):
+		msg = self._recvFrame()
+		if msg is None:
+			return None
+		payload = self.channel.decode(msg)
+		if payload is not None:
+			self._payloads.append(payload)
+		return msg
+
+	def send(self, msg):
+		'''Send the payload to the Stub'''
+		if len(msg) >= self.channel.threshold:
+			# Learn of any space the Stub has freed in the ring since
+			while len(select.select([self.socket], [], [], 0)[0]) > 0:
+				if self._receive() is None:
+					break
+		self.channel.send(msg)
+
+	def recvPayload(self):
+		'''Wait for the next BulkPayload from the Stub and return it. Returns None
+		   if the Stub has disconnected.
+		'''
+		while len(self._payloads) == 0:
+			if self._receive() is None:
+				return None
+		return self._payloads.popleft()
+
+	def recv(self):
+		'''Wait for the next payload from the Stub and return a copy of it.
+		   Returns None if the Stub has disconnected.
+		'''
+		payload = self.recvPayload()
+		if payload is None:
+			return None
+		data = payload.tobytes()
+		payload.release()
+		return data
+
+	def close(self):
+		StubClient.close(self)
+		self.channel.close()
+
 class TestCase(unittest.TestCase):
 	# Setting changable by subclasses for whether the tests will output verbosely or not. The
 	# output of the test runner will be modified as appropriate to make it easier to read.
@@ -1548,6 +4717,9 @@ if __name__ == '__main__':
 		def __init__(self):
 			self.start = time.time()
 
+			# ProcessUsage of every Process started by the test
+			self.processes = []
+
 		def setUp(self):
 			self.setup = time.time()
 
@@ -1600,6 +4772,8 @@ if __name__ == '__main__':
 			timing = TestTiming()
 			self.timings[test.id()] = timing
 			test.timing = timing
+			unittest._lousy_process_usage = timing.processes
+			unittest._lousy_stubs.reset()
 
 			unittest.TestResult.startTest(self, test)
 
@@ -1608,6 +4782,7 @@ if __name__ == '__main__':
 
 		def stopTest(self, test):
 			test.timing.stop()
+			unittest._lousy_process_usage = None
 
 			unittest.TestResult.stopTest(self, test)
 
@@ -1650,6 +4825,31 @@ if __name__ == '__main__':
 
 			self.printList('ERROR', self.errors)
 			self.printList('FAIL', self.failures)
+			self.printProcessUsage()
+
+		def printProcessUsage(self, count=10):
+			# List the processes which consumed the most CPU along with the
+			# test which started them.
+			usages = []
+			for test_id, timing in self.timings.items():
+				for usage in timing.processes:
+					usages.append((usage.cpuTime(), test_id, usage))
+
+			if len(usages) == 0:
+				return
+
+			usages.sort(reverse=True)
+
+			self.output('Top process resource consumers:')
+			for cpu, test_id, usage in usages[:count]:
+				read_bytes, write_bytes = usage.ioBytes()
+				if usage.readyTime is None:
+					ready = '%9s' % '-'
+				else:
+					ready = '%8.3fs' % usage.readyTime
+				self.output('  %8.3fs cpu %8.3fs run %s ready %8dKB rss %10dB read %10dB written  %s(%d) in %s' %
+						(cpu, usage.runtime(), ready, usage.maxRss() / 1024,
+						read_bytes, write_bytes, usage.command[0], usage.pid, test_id))
 
 		def printList(self, prefix, errors):
 			for test, error in errors:
@@ -1660,112 +4860,162 @@ if __name__ == '__main__':
 		def _makeResult(self):
 			return TestResult()
 
-	class ProtoStub(asyncore.dispatcher):
+	class ProtoStub(object):
 		# This is a stub connection after the new socket has been
 		# accept()ed from StubListener, but before any data has been
 		# read which will let us determine the stub class to
 		# instantiate.
 
-		def writable(self):
-			return False
-
-		def handle_read(self):
-			# Remove ourself from the global list of sockets to
-			# watch and send our socket to StubCentral to be
-			# reborn as a new Stub class according to its type.
-			buf = self.socket.recv(100, socket.MSG_PEEK)
-
-			if len(buf) >= struct.calcsize(MSG_HEADER_FMT):
-				self.del_channel()
-				self.stub._new_stub(self.socket)
-			elif not buf:
-				# Socket has been closed by the far end
-				self.close()
-
-	class StubListener(asyncore.dispatcher):
-		# This is a class which listens for new stub connections
-		def __init__(self, stubcentral):
-			asyncore.dispatcher.__init__(self)
-
+		def __init__(self, sock, stubcentral):
+			self.socket = sock
+			self.socket.setblocking(0)
 			self.stub = stubcentral
+			self.decoder = FrameDecoder()
 
-			self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-			self.port = DEFAULT_PORT
-			while True:
-				try:
-					self.bind(('localhost', self.port))
-					break
-				except:
-					self.port += 1
-			self.listen(5)
-
-		def handle_accept(self):
-			sock, address = self.accept()
-			protostub = ProtoStub(sock)
-			protostub.stub = self.stub
+		def fileno(self):
+			return self.socket.fileno()
 
+		def close(self):
+			self.reactor.unregister(self)
+			self.socket.close()
 
-		def writable(self):
-			return False
-
-	class StubPoker(asyncore.dispatcher):
-		# This is dispatcher used to get out of the select loop. It
-		# uses a pair of sockets to be portable
+		def handle_write(self):
+			pass
 
-		def __init__(self):
-			self.s1, self.s2 = socket.socketpair()
+		def handle_read(self):
+			# Stop watching the socket ourself and send it to
+			# StubCentral to be reborn as a new Stub class
+			# according to its type.
+			try:
+				messages = self.decoder.receive(self.socket)
+			except socket.error as e:
+				if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+					return
+				if e.args[0] not in (errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN):
+					raise
+				messages = None
 
-			asyncore.dispatcher.__init__(self, sock = self.s1)
+			if messages is None:
+				# Socket has been closed by the far end
+				self.close()
+			elif len(messages) > 0:
+				# Anything received after the registration message
+				# is handed over along with the decoder
+				self.reactor.unregister(self)
+				self.stub._new_stub(self.socket, messages[0], self.decoder, messages[1:])
+
+	class StubListener(object):
+		# This is a class which listens for new stub connections, on
+		# TCP or, if path is given, on that UNIX domain socket
+		def __init__(self, stubcentral, path=None):
+			self.stub = stubcentral
+			self.port = None
+			self.path = path
 
-		def writable(self):
-			return False
+			if path is not None:
+				self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+				self.socket.bind(path)
+			else:
+				self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+				self.port = DEFAULT_PORT
+				while True:
+					try:
+						self.socket.bind(('localhost', self.port))
+						break
+					except:
+						self.port += 1
+			self.socket.listen(128)
+			flags = fcntl.fcntl(self.socket.fileno(), fcntl.F_GETFD)
+			fcntl.fcntl(self.socket.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+			self.socket.setblocking(0)
+
+		def fileno(self):
+			return self.socket.fileno()
+
+		def close(self):
+			self.reactor.unregister(self)
+			self.socket.close()
+
+		def handle_write(self):
+			pass
 
 		def handle_read(self):
-			# Throw away the data since it doesn't matter and has served its purpose
-			s = self.recv(100)
-
-		def trigger(self):
-			self.s2.send('a')
+			# Accept every connection which is waiting
+			while True:
+				try:
+					sock, address = self.socket.accept()
+				except socket.error as e:
+					if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR,
+							errno.ECONNABORTED):
+						return
+					raise
+				if self.port is not None:
+					sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+				flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+				fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+				self.reactor.register(ProtoStub(sock, self.stub))
 
 	class StubCentral(threading.Thread):
-		'''This is an asyncore based server which provides a TCP
-		   based method to control external programs. The intended
-		   usecase is to have written stub classes/functions in the
-		   language of the application being tested and use some
-		   simple stub functionality to control that from the test
-		   framework. This is the central clearing house for
-		   registering, creating and finding Stub object.
+		'''This is an epoll based server which provides a TCP
+		   and UNIX domain socket based method to control
+		   external programs. The intended usecase is to have
+		   written stub classes/functions in the language of the
+		   application being tested and use some simple stub
+		   functionality to control that from the test framework.
+		   This is the central clearing house for registering,
+		   creating and finding Stub object.
 		'''
 
 		_lock = None
+		_tcpLock = None
 		_port = None
-		_listener = None
-		_poker = None
+		_listener = None # Only created once port() is called
+		_unixListener = None
+		_path = None
+		_reactor = None
 		_classes = {}
-		_objects = {}
+		_objects = None # id -> stub
+		_unclaimed = None # type -> stubs not yet returned by waitForStub(), oldest first
+		_waiters = None # (kind, key) -> [Condition, waiting threads], see _waiter()
 		_running = True
 		_ready = None
 		_newest = None
-		_stub_created = None
 
 		def __init__(self):
 			threading.Thread.__init__(self, name='StubCentral')
 
 			self._lock = threading.Lock()
+			self._tcpLock = threading.Lock()
 			self._ready = threading.Event()
-			self._stub_created = threading.Event()
+			self._objects = {}
+			self._unclaimed = {None: collections.OrderedDict()}
+			self._waiters = {}
 
 		def _init(self):
-			self._listener = StubListener(self)
-			self._port = self._listener.port
-			self._poker = StubPoker()
+			self._reactor = Reactor(self)
+
+			# The TCP port is only searched for once port() is
+			# called, local stubs can avoid TCP altogether
+			directory = tempfile.mkdtemp(prefix='lousy-stubs-')
+			self._unixListener = StubListener(self, os.path.join(directory, 'stubs'))
+			self._reactor.register(self._unixListener)
+			self._path = self._unixListener.path
+
 			self._ready.set()
 
-		def _new_stub(self, sock):
-			# Handle a new connection and create an object of
-			# the appropriate stub class.
-			msg = _readStubMessage(sock)
+		def _cleanup(self):
+			for listener in (self._listener, self._unixListener):
+				if listener is not None:
+					listener.close()
+			if self._path is not None:
+				os.unlink(self._path)
+				os.rmdir(os.path.dirname(self._path))
+			self._reactor.close()
 
+		def _new_stub(self, sock, msg, decoder, messages):
+			# Handle a new connection and create an object of
+			# the appropriate stub class. msg is the registration
+			# message, messages any which followed it.
 			type, id = msg.split(',')
 
 			if id in self._objects:
@@ -1783,38 +5033,116 @@ if __name__ == '__main__':
 					type = 'SimpleStub'
 
 			stub.stubcentral = self
+			stub._decoder = decoder
+			self._reactor.register(stub)
 
 			if create_callback is not None:
 				create_callback(stub, type)
 
-			self._lock.acquire()
-			self._newest = stub
-			self._stub_created.set()
-			self._lock.release()
-
-		def waitForStub(self, type=None, timeout=5):
-			'''Wait until the timeout expires or a stub of the
-			   given class is created. Return the object of that
-			   stub.
-
-			   If type is None then return the next stub to be
-			   created.
+			if len(messages) > 0:
+				stub._received(messages)
+
+			# The stub is found both by the type it registered as and
+			# the type of the class created for it
+			stub.id = id
+			stub.types = set([type, stub.type])
+
+			with self._lock:
+				self._newest = stub
+				self._objects[id] = stub
+				for key in stub.types | set([None]):
+					self._unclaimed.setdefault(key, collections.OrderedDict())[stub] = True
+					self._notify('type', key)
+				self._notify('id', id)
+
+		def _wait(self, kind, key, timeout):
+			# Wait for a stub with the given type or id to be registered.
+			# Must be called with the lock held. The condition is only
+			# kept while some thread is waiting on it.
+			waiter = self._waiters.get((kind, key))
+			if waiter is None:
+				waiter = [threading.Condition(self._lock), 0]
+				self._waiters[(kind, key)] = waiter
+			waiter[1] += 1
+			try:
+				waiter[0].wait(timeout)
+			finally:
+				waiter[1] -= 1
+				if waiter[1] == 0 and self._waiters.get((kind, key)) is waiter:
+					del self._waiters[(kind, key)]
+
+		def _notify(self, kind, key):
+			waiter = self._waiters.get((kind, key))
+			if waiter is not None:
+				waiter[0].notify_all()
+
+		def _claim(self, stub):
+			# Must be called with the lock held
+			for key in stub.types | set([None]):
+				self._unclaimed[key].pop(stub, None)
+
+		def waitForStub(self, type=None, timeout=5, id=None):
+			'''Wait until the timeout expires for a stub of the
+			   given type to be created. Return the object of that
+			   stub or None if there was none in time.
+
+			   Every stub is returned only once in the order they
+			   were created, so if several stubs connect in quick
+			   succession then each call returns the next. If type
+			   is None then return the next stub of any type.
+
+			   If id is given then return the stub which registered
+			   with that id, whether or not it has been returned
+			   before.
 			'''
-			startTime = time.time()
-
-			timeLeft = timeout - (time.time() - startTime)
-			while timeLeft > 0:
-				self._stub_created.wait(timeLeft)
-
-				with self._lock:
-					self._stub_created.clear()
-
-					if type is None:
-						return self._newest
-					elif self._newest.type == type:
-						return self._newest
-
-				timeLeft = timeLeft - (time.time() - startTime)
+			if id is not None:
+				kind, key = 'id', id
+				def find():
+					stub = self._objects.get(id)
+					if stub is not None and (type is None or type in stub.types):
+						return stub
+					return None
+			else:
+				kind, key = 'type', type
+				def find():
+					unclaimed = self._unclaimed.get(type)
+					if not unclaimed:
+						return None
+					return next(iter(unclaimed))
+
+			end = time.time() + timeout
+			with self._lock:
+				stub = find()
+				while stub is None:
+					remaining = end - time.time()
+					if remaining <= 0:
+						return None
+					self._wait(kind, key, remaining)
+					stub = find()
+
+				self._claim(stub)
+				return stub
+
+		def stub(self, id):
+			'''Return the stub which registered with the given id or
+			   None if there is no such stub.
+			'''
+			with self._lock:
+				return self._objects.get(id)
+
+		def reset(self):
+			'''Forget every stub created so far. This is done as each
+			   test starts so that stubs left over from one test are
+			   not returned to the next. Threads already in
+			   waitForStub() keep waiting for new stubs.
+			'''
+			with self._lock:
+				self._objects = {}
+				self._unclaimed = {None: collections.OrderedDict()}
+				self._newest = None
+				for waiter in self._waiters.values():
+					waiter[0].notify_all()
+				self._waiters = {}
 
 		def newest(self):
 			self._lock.acquire()
@@ -1853,50 +5181,87 @@ if __name__ == '__main__':
 
 		def trigger(self):
 			# We've been triggered, so we need to exit the
-			# select loop and reprocess.
-			self._poker.trigger()
-
-		def stop(self):
+			# poll and reprocess.
+			if self._reactor is not None:
+				self._reactor.wake()
+
+		def stop(self, timeout=5):
+			'''Stop serving stubs and wait until the timeout for
+			   the thread to exit. Does nothing if the stub
+			   protocol was never used.
+			'''
 			self._lock.acquire()
 			self._running = False
 			self._lock.release()
 
 			if self.is_alive():
 				self.trigger()
+				self.join(timeout)
 
 		def ready(self):
 			'''Ensure that the stub protocol is ready for use.
+			   Nothing is created until this is first called
+			   since many runs never use stubs at all. The
+			   listening sockets are bound before returning, so
+			   stubs may connect immediately, and the thread
+			   serving them is started.
 			'''
-			if not self._ready.is_set():
-				self.start()
-				self._ready.wait()
+			if self._ready.is_set():
+				return
+
+			with self._lock:
+				if not self._ready.is_set():
+					self._init()
+					self.start()
 
 		def port(self):
 			'''Return the port needed to connect stubs to this
 			   instance of lousy. This port will always be bound
-			   to IPv4 localhost on the specified port.
+			   to IPv4 localhost on the specified port. The port
+			   is only bound when this is first called.
 			'''
 			self.ready()
-			return self._port
-
-		def run(self):
-			# We don't create the socket until we are run
-			# because many tests won't need the Stub at all and
-			# it'd be wasteful to create them otherwise.
-			self._lock.acquire()
 			if self._port is None:
-				self._init()
-
-			self._running = True
-			self._lock.release()
+				# Not the main lock, which the StubCentral thread
+				# needs to finish the registration
+				with self._tcpLock:
+					if self._port is None:
+						self._listener = StubListener(self)
+						self._reactor.register(self._listener)
+						self._port = self._listener.port
+			return self._port
 
-			still_running = True
-			while still_running:
-				asyncore.loop(timeout=5, use_poll=True, count=1)
+		def path(self):
+			'''Return the path of the UNIX domain socket stubs on this
+			   machine can connect to instead of the TCP port.
+			'''
+			self.ready()
+			return self._path
+
+		def socketpair(self):
+			'''Return one end of a new connected pair of sockets,
+			   the other end of which is treated as a newly
+			   connected stub. The far end must still register
+			   itself as usual. This lets a stub be handed to a
+			   child process without it having to connect at all,
+			   see the stub argument of Process.
+			'''
+			self.ready()
+			ours, theirs = socket.socketpair()
+			for sock in (ours, theirs):
+				flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+				fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+			self._reactor.register(ProtoStub(ours, self))
+			return theirs
 
-				self._lock.acquire()
-				still_running = self._running
-				self._lock.release()
+		def run(self):
+			# The sockets were created by ready() before the
+			# thread was started
+			try:
+				while self._running:
+					self._reactor.poll()
+			finally:
+				self._cleanup()
 
 	# A little class which wraps a file and prepends the date and time to every line.
 	class DatedFileWrapper(object):
@@ -1984,6 +5349,14 @@ if __name__ == '__main__':
 		global _debug
 		_debug = args.debug
 
+		unittest._lousy_regex_cache = RegexCache(args.regex_cache)
+		unittest._lousy_child_watcher = _childWatcher
+
+		if args.launcher:
+			# Fork the launcher before the runner grows by loading the tests
+			unittest._lousy_launcher = ProcessLauncher()
+			unittest._lousy_launcher.start()
+
 		sys.stdout = DatedFileWrapper(sys.stdout)
 
 		if stubs is None:
@@ -2016,10 +5389,140 @@ if __name__ == '__main__':
 		runner = TestRunner()
 		runner.run(tests)
 
+		if _debug:
+			print unittest._lousy_regex_cache
+
 		unittest._lousy_stubs.stop()
+		_childWatcher.close()
+
+		if args.launcher:
+			unittest._lousy_launcher.stop()
 
 		return True
 
+	class BenchEchoStub(Stub):
+		# Answers every message itself from the StubCentral thread
+		type = 'BenchEcho'
+
+		def consume_read(self, msg):
+			self.write(msg)
+			return True
+
+	def percentile(values, percent):
+		# values must already be sorted
+		index = int(math.ceil(len(values) * percent / 100.0)) - 1
+		return values[max(0, min(index, len(values) - 1))]
+
+	def cpu_time():
+		# CPU seconds used by this process. getrusage() is far finer grained
+		# than the clock ticks of os.times().
+		usage = resource.getrusage(resource.RUSAGE_SELF)
+		return usage.ru_utime + usage.ru_stime
+
+	def bench_stubs(args):
+		# Measure round trips between StubClients and Stubs, first with the
+		# test reading and answering through a SimpleStub and then with a Stub
+		# answering from consume_read(). The clients run in this process so the
+		# CPU time includes both ends. Returns False if the round trips didn't
+		# all complete, waiting at most timeout seconds for any one step.
+		timeout = 5
+		central = StubCentral()
+		port = central.port()
+
+		created = threading.Condition()
+		simple_stubs = []
+		def stub_created(stub, type):
+			with created:
+				simple_stubs.append(stub)
+				created.notify()
+		central.add_class('BenchSimple', SimpleStub, stub_created)
+		central.add_class('BenchEcho', BenchEchoStub)
+
+		msg = 'x' * args.size
+
+		def run_clients(type, responder=None):
+			clients = [StubClient(type, '%s%d' % (type, i), port) for i in range(args.clients)]
+			for client in clients:
+				client.socket.settimeout(timeout)
+			latencies = [[] for client in clients]
+			failures = []
+
+			def client_loop(client, results):
+				for i in range(args.messages):
+					start = time.time()
+					try:
+						client.send(msg)
+						reply = client.recv()
+					except socket.timeout:
+						reply = None
+					if reply is None:
+						failures.append('%s client received no reply' % type)
+						return
+					results.append(time.time() - start)
+
+			threads = [threading.Thread(target=client_loop, args=(client, results))
+					for client, results in zip(clients, latencies)]
+
+			if responder is not None:
+				deadline = time.time() + timeout
+				with created:
+					while len(simple_stubs) < len(clients):
+						remaining = deadline - time.time()
+						if remaining <= 0:
+							print 'Error: only %d of %d %s stubs registered' % (len(simple_stubs),
+									len(clients), type)
+							for client in clients:
+								client.close()
+							return False
+						created.wait(remaining)
+				threads += [threading.Thread(target=responder, args=(stub, failures))
+						for stub in simple_stubs]
+
+			cpu_start = cpu_time()
+			start = time.time()
+			for thread in threads:
+				thread.daemon = True
+				thread.start()
+			for thread in threads:
+				thread.join()
+			elapsed = time.time() - start
+			cpu = cpu_time() - cpu_start
+
+			for client in clients:
+				client.close()
+
+			if failures:
+				print 'Error: %s' % failures[0]
+				return False
+
+			results = sorted(sum(latencies, []))
+			print '%s: %d clients, %d round trips of %d bytes' % (type, len(clients), len(results), args.size)
+			print '  latency p50 %.3fms p90 %.3fms p99 %.3fms max %.3fms' % tuple(
+					[percentile(results, p) * 1000 for p in (50, 90, 99, 100)])
+			print '  %.0f messages/s, %.1fus cpu per message' % (len(results) / elapsed,
+					cpu / len(results) * 1000000)
+			return True
+
+		def simple_responder(stub, failures):
+			for i in range(args.messages):
+				msg = stub.read(timeout)
+				if msg == '':
+					failures.append('BenchSimple stub received no message')
+					return
+				stub.write(msg)
+
+		try:
+			return run_clients('BenchSimple', simple_responder) and run_clients('BenchEcho')
+		finally:
+			central.stop()
+			central.join()
+
+	def cmd_bench(args):
+		benchmarks = {
+				'stubs': bench_stubs,
+				}
+		return benchmarks[args.target](args)
+
 	parser = argparse.ArgumentParser(prog='lousy', description='Test Runner with Bug Tracker Integration')
 	subcmds = parser.add_subparsers(help='command help')
 
@@ -2033,9 +5536,18 @@ if __name__ == '__main__':
 	run_cmd.add_argument('-s', '--slow', action='store_true', help='Run the slow tests')
 	run_cmd.add_argument('-C', '--constrained', action='store_true', help='Run the constrained tests')
 	run_cmd.add_argument('-d', '--debug', action='store_true', help='Output debug logging while running tests')
+	run_cmd.add_argument('-l', '--launcher', action='store_true', help='Spawn processes from a small pre-forked helper process')
+	run_cmd.add_argument('--regex-cache', type=int, default=512, metavar='SIZE', help='Number of compiled regexes to keep for expect')
 	run_cmd.add_argument('re', nargs='?', default='.+', help='Regex used to filter run tests')
 	run_cmd.set_defaults(func=cmd_run)
 
+	bench_cmd = subcmds.add_parser('bench', help='Benchmark parts of lousy itself')
+	bench_cmd.add_argument('target', choices=['stubs'], help='What to benchmark')
+	bench_cmd.add_argument('-n', '--clients', type=int, default=10, help='Number of concurrent connections')
+	bench_cmd.add_argument('-m', '--messages', type=int, default=1000, help='Round trips per connection')
+	bench_cmd.add_argument('-s', '--size', type=int, default=64, help='Size of each message in bytes')
+	bench_cmd.set_defaults(func=cmd_bench)
+
 	# Make it possible for tests to import modules from their parent tests directory
 	test_path = os.getcwd() + '/tests'
 	sys.path.append(test_path)
@@ -0,0 +1,732 @@
+# Tests of the Process class
+
+import lousy
+import os
+import re
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+class ProcessTestCase(lousy.TestCase):
+	pass
+
+class ProcessTests(ProcessTestCase):
+	def test_expectOutput(self):
+		proc = lousy.Process(['echo', 'hello world'])
+
+		self.assertEqual(proc.expect(['goodbye', 'hello']), 1)
+		self.assertTrue(proc.waitForTermination())
+		self.assertEqual(proc.returncode, 0)
+
+	def test_ptyEcho(self):
+		proc = lousy.Process(['cat'], pty='vt100')
+
+		proc.sendLine('abc')
+		self.assertEqual(proc.expect(['abc']), 0)
+
+		proc.terminate()
+		self.assertFalse(proc.running)
+
+	def test_expectScreen(self):
+		proc = lousy.Process(['sh', '-c', 'printf "\\033[2J\\033[10;20Hready"; exec sleep 5'], pty='vt100')
+
+		self.assertEqual(proc.expectScreen(['missing', 'ready']), (1, (9, 19)))
+		self.assertEqual(proc.expectScreen(['ready'], region=(0, 0, 8, 79), timeout=0.2), (-1, None))
+		self.assertEqual(proc.expectScreen(['^ready'], region=(9, 19, 9, 30)), (0, (9, 19)))
+
+		proc.terminate()
+		self.assertRaises(ValueError, lousy.Process(['true']).expectScreen, ['x'])
+
+	def test_lazyVty(self):
+		proc = lousy.Process(['sh', '-c', 'printf "\\033[5;3Hlazy"; exec sleep 5'], pty='vt100',
+				vtyMode='lazy')
+
+		self.assertEqual(proc.expectScreen(['lazy']), (0, (4, 2)))
+		self.assertEqual(proc.vty.string(4, 2, 4), 'lazy')
+
+		proc.terminate()
+
+	def test_lazyVtyNotInterpretedOnExit(self):
+		proc = lousy.Process(['sh', '-c', 'printf "\\033[5;3Hlazy"'], pty='vt100',
+				vtyMode='lazy')
+
+		self.assertTrue(proc.waitForTermination())
+		self.assertNotEqual(proc.vty._journal, [])
+		self.assertEqual(proc.vty.string(4, 2, 4), 'lazy')
+
+	def test_threadVty(self):
+		proc = lousy.Process(['sh', '-c', 'printf "\\033[7;3Hthreaded"'], pty='vt100',
+				vtyMode='thread')
+
+		self.assertTrue(proc.waitForTermination())
+		self.assertEqual(proc.vty.string(6, 2, 8), 'threaded')
+		self.assertFalse(proc.vty._worker.is_alive())
+
+class LauncherTests(ProcessTestCase):
+	def setUp1(self):
+		self.saved_launcher = lousy.launcher
+		lousy.launcher = lousy.ProcessLauncher()
+		lousy.launcher.start()
+
+	def tearDown1(self):
+		lousy.launcher.stop()
+		lousy.launcher = self.saved_launcher
+
+	def test_launchedProcessOutput(self):
+		proc = lousy.Process(['echo', 'launched'])
+
+		self.assertIsInstance(proc.process, lousy.LaunchedProcess)
+		self.assertEqual(proc.expect(['launched']), 0)
+		self.assertTrue(proc.waitForTermination())
+		self.assertEqual(proc.returncode, 0)
+
+	def test_launchedProcessExitCode(self):
+		proc = lousy.Process(['exit 3'], shell=True)
+
+		self.assertTrue(proc.waitForTermination())
+		self.assertEqual(proc.returncode, 3)
+
+	def test_launchedProcessKill(self):
+		proc = lousy.Process(['sleep', '10'])
+
+		proc.terminate()
+		self.assertEqual(proc.returncode, -9)
+
+	def test_launchedProcessNotSignalledOnceReaped(self):
+		proc = lousy.Process(['true'])
+		self.assertTrue(proc.waitForTermination())
+
+		# The pid may already belong to another process
+		self.assertFalse(lousy.launcher.signal(proc.process.pid, 0))
+
+	def test_launcherExitReported(self):
+		proc = lousy.Process(['sleep', '10'])
+		lousy.launcher.stop()
+
+		try:
+			self.assertRaises(OSError, proc.waitForTermination)
+			self.assertRaises(OSError, proc.sendSignal, signal.SIGKILL)
+		finally:
+			os.kill(proc.process.pid, signal.SIGKILL)
+
+	def test_launchedPty(self):
+		proc = lousy.Process(['cat'], pty='vt100')
+
+		proc.sendLine('xyz')
+		self.assertEqual(proc.expect(['xyz']), 0)
+		proc.terminate()
+
+	def test_launchNonExistentCommand(self):
+		self.assertRaises(OSError, lousy.Process, ['/nonexistent/command'])
+
+class ProcessSpawnTests(ProcessTestCase):
+	def test_env(self):
+		proc = lousy.Process(['sh', '-c', 'echo "[$LOUSY_TEST]"'],
+				env={'LOUSY_TEST': 'value', 'PATH': os.environ['PATH']})
+		self.assertEqual(proc.expect(['\[value\]']), 0)
+		self.assertTrue(proc.waitForTermination())
+
+	def test_cwd(self):
+		proc = lousy.Process(['pwd'], cwd='/')
+		self.assertEqual(proc.expect(['^/$']), 0)
+		self.assertTrue(proc.waitForTermination())
+
+	def test_badCwd(self):
+		self.assertRaises(OSError, lousy.Process, ['true'], cwd='/nonexistent/directory')
+
+	def test_passFds(self):
+		r, w = os.pipe()
+		try:
+			proc = lousy.Process(['sh', '-c', 'echo passed > /proc/self/fd/%d' % w], pass_fds=[w])
+			os.close(w)
+			self.assertTrue(proc.waitForTermination())
+			self.assertEqual(proc.returncode, 0)
+			self.assertEqual(os.read(r, 100), 'passed\n')
+		finally:
+			os.close(r)
+
+	def test_closeFds(self):
+		r, w = os.pipe()
+		try:
+			proc = lousy.Process(['sh', '-c', 'echo leaked > /proc/self/fd/%d' % w], close_fds=True)
+			self.assertTrue(proc.waitForTermination())
+			self.assertNotEqual(proc.returncode, 0)
+		finally:
+			os.close(r)
+			os.close(w)
+
+	def test_preexec(self):
+		proc = lousy.Process(['sh', '-c', 'echo "[$LOUSY_PREEXEC]"'],
+				preexec=lambda: os.putenv('LOUSY_PREEXEC', 'ran'))
+		self.assertEqual(proc.expect(['\[ran\]']), 0)
+		self.assertTrue(proc.waitForTermination())
+
+class LaunchedSpawnTests(ProcessSpawnTests):
+	def setUp1(self):
+		self.saved_launcher = lousy.launcher
+		lousy.launcher = lousy.ProcessLauncher()
+		lousy.launcher.start()
+
+	def tearDown1(self):
+		lousy.launcher.stop()
+		lousy.launcher = self.saved_launcher
+
+class ProcessInputTests(ProcessTestCase):
+	def test_sendAllLargerThanPipes(self):
+		# cat blocks writing its output unless we read while writing the input
+		data = ('a' * 1023 + '\n') * 256
+		proc = lousy.Process(['cat'])
+
+		self.assertTrue(proc.sendAll(data, timeout=10))
+		self.assertEqual(proc.stdin.pending(), 0)
+
+		proc.sendLine('done')
+		self.assertEqual(proc.expect(['^done$']), 0)
+		proc.terminate()
+
+	def test_flushInputWithNothingQueued(self):
+		proc = lousy.Process(['cat'])
+
+		self.assertTrue(proc.flushInput(timeout=0))
+		proc.terminate()
+
+class ProcessOutputStreamTests(ProcessTestCase):
+	def test_heavyStderrDoesntBlockStdout(self):
+		# Far more than fits in the stderr pipe
+		proc = lousy.Process(['head -c 1000000 /dev/zero >&2; echo finished'], shell=True)
+
+		self.assertEqual(proc.expect(['finished'], timeout=10), 0)
+		proc.terminate()
+
+	def test_expectStderr(self):
+		proc = lousy.Process(['echo out; echo err >&2'], shell=True)
+
+		self.assertEqual(proc.expect(['err'], stream='stderr'), 0)
+		self.assertEqual(proc.expect(['out']), 0)
+		proc.terminate()
+
+	def test_mergedOrdering(self):
+		proc = lousy.Process(['echo one; sleep 0.1; echo two >&2; sleep 0.1; echo three'], shell=True,
+				mergedOutput=True)
+		self.assertTrue(proc.waitForTermination())
+		proc.flushOutput()
+
+		lines = []
+		entry = proc.readMergedLine()
+		while entry is not None:
+			lines.append(entry)
+			entry = proc.readMergedLine()
+
+		self.assertEqual([(stream, line) for seq, stream, line in lines],
+				[('stdout', 'one'), ('stderr', 'two'), ('stdout', 'three')])
+		self.assertEqual(sorted(lines), lines)
+
+	def test_mergedKeptBounded(self):
+		proc = lousy.Process(['seq', '1', '20000'])
+		proc.mergedOutputKept = 1000
+
+		self.assertEqual(proc.expect(['^20000$'], timeout=20), 0)
+		self.assertLessEqual(proc._mergedBytes, 1000)
+
+		lines = []
+		entry = proc.readMergedLine()
+		while entry is not None:
+			lines.append(entry[2])
+			entry = proc.readMergedLine()
+		self.assertEqual(lines[-1], '20000')
+		self.assertNotEqual(lines[0], '1')
+		proc.terminate()
+
+	def test_expectBothAfterStreamRead(self):
+		proc = lousy.Process(['echo early >&2; sleep 0.1; echo out'], shell=True)
+
+		self.assertEqual(proc.expect(['out']), 0)
+		self.assertEqual(proc.expect(['early'], stream='both'), 0)
+		proc.terminate()
+
+	def test_mergedAfterFirstUse(self):
+		proc = lousy.Process(['sleep 0.2; echo one; echo two >&2; echo three'], shell=True)
+
+		lines = []
+		deadline = time.time() + 5
+		while len(lines) < 3 and time.time() < deadline:
+			entry = proc.readMergedLine()
+			if entry is not None:
+				lines.append(entry[1:])
+		self.assertEqual(sorted(lines), [('stderr', 'two'), ('stdout', 'one'), ('stdout', 'three')])
+		proc.terminate()
+
+	def test_expectBoth(self):
+		proc = lousy.Process(['echo err >&2'], shell=True)
+
+		self.assertEqual(proc.expect(['out', 'err'], stream='both'), 1)
+		proc.terminate()
+
+	def test_invalidStream(self):
+		proc = lousy.Process(['true'])
+
+		self.assertRaises(ValueError, proc.expect, ['x'], stream='stdxxx')
+		proc.terminate()
+
+class ProcessTerminationTests(ProcessTestCase):
+	def test_waitForTerminationIsPrompt(self):
+		proc = lousy.Process(['sleep', '0.2'])
+
+		start = time.time()
+		self.assertTrue(proc.waitForTermination())
+		self.assertLess(time.time() - start, 1)
+		self.assertEqual(proc.returncode, 0)
+
+	def test_waitForTerminationTimeout(self):
+		proc = lousy.Process(['sleep', '10'])
+
+		self.assertFalse(proc.waitForTermination(timeout=0.1))
+		self.assertTrue(proc.running)
+		proc.terminate()
+
+	def test_outputCollectedAfterExit(self):
+		proc = lousy.Process(['echo', 'last words'])
+
+		self.assertTrue(proc.waitForTermination())
+		self.assertEqual(proc.readLine(), 'last words')
+
+	def test_gracefulTerminate(self):
+		proc = lousy.Process(['sleep', '10'])
+
+		proc.terminate(graceful_timeout=1)
+		self.assertEqual(proc.returncode, -signal.SIGTERM)
+
+	def test_gracefulTerminateIgnored(self):
+		proc = lousy.Process(['trap "" TERM; echo ready; sleep 10'], shell=True)
+		self.assertEqual(proc.expect(['ready']), 0)
+
+		proc.terminate(graceful_timeout=0.1)
+		self.assertEqual(proc.returncode, -signal.SIGKILL)
+
+class ChildWatcherTests(ProcessTestCase):
+	def setUp1(self):
+		# Set aside whichever wakeup fd the shared watcher may have installed
+		self.saved = signal.set_wakeup_fd(-1)
+		self.pipe = os.pipe()
+
+	def tearDown1(self):
+		signal.set_wakeup_fd(self.saved)
+		for fd in self.pipe:
+			os.close(fd)
+
+	def test_wakeupFdRestored(self):
+		handler = signal.getsignal(signal.SIGCHLD)
+		watcher = lousy._ChildWatcher()
+		self.assertIsNotNone(watcher.fileno())
+
+		watcher.close()
+		self.assertEqual(signal.set_wakeup_fd(-1), -1)
+		self.assertEqual(signal.getsignal(signal.SIGCHLD), handler)
+
+	def test_existingWakeupFdKept(self):
+		signal.set_wakeup_fd(self.pipe[1])
+		watcher = lousy._ChildWatcher()
+
+		self.assertIsNone(watcher.fileno())
+		self.assertEqual(signal.set_wakeup_fd(-1), self.pipe[1])
+
+		# Not asked for again even once it is free
+		self.assertIsNone(watcher.fileno())
+		self.assertEqual(signal.set_wakeup_fd(-1), -1)
+
+class ProcessGroupTests(ProcessTestCase):
+	def setUp1(self):
+		self.group = lousy.ProcessGroup()
+
+	def tearDown1(self):
+		self.group.terminate()
+
+	def test_parallelTeardown(self):
+		for i in range(10):
+			self.group.start(['sleep', '10'])
+
+		start = time.time()
+		results = self.group.terminate()
+
+		self.assertLess(time.time() - start, 2)
+		self.assertEqual(len(results), 10)
+		for result in results:
+			self.assertEqual(result.returncode, -signal.SIGKILL)
+			self.assertGreater(result.runtime, 0)
+
+	def test_gracefulTeardown(self):
+		polite = self.group.start(['sleep', '10'])
+		stubborn = self.group.start(['trap "" TERM; echo ready; sleep 10'], shell=True)
+		self.assertEqual(stubborn.expect(['ready']), 0)
+
+		results = self.group.terminate(graceful_timeout=0.2)
+
+		self.assertEqual(results[0].returncode, -signal.SIGTERM)
+		self.assertEqual(results[1].returncode, -signal.SIGKILL)
+
+	def test_grandchildrenKilled(self):
+		proc = self.group.start(['sleep 10 & echo $!; wait'], shell=True)
+		line = None
+		for i in range(100):
+			line = proc.readLine()
+			if line is not None:
+				break
+		grandchild = int(line)
+
+		self.group.terminate()
+		self.assertKilled(grandchild)
+
+	def assertKilled(self, pid):
+		# The grandchild is reparented, so just check it is gone or a zombie.
+		# Delivery of SIGKILL isn't instantaneous so give it a moment.
+		state = None
+		for i in range(100):
+			try:
+				with open('/proc/%d/stat' % pid) as f:
+					state = f.read().split(') ')[1].split()[0]
+			except IOError:
+				state = None
+			if state in (None, 'Z'):
+				break
+			time.sleep(0.01)
+		self.assertIn(state, (None, 'Z'))
+
+	def startWithStubbornGrandchild(self):
+		# The child exits on SIGTERM but its child ignores it, the grandchild
+		# only gives its pid once it does
+		proc = self.group.start(['sh -c \'trap "" TERM; echo $$; exec sleep 10\' & wait'], shell=True)
+		line = None
+		for i in range(100):
+			line = proc.readLine()
+			if line is not None:
+				break
+		return proc, int(line)
+
+	def test_gracefulTeardownKillsGrandchildren(self):
+		proc, grandchild = self.startWithStubbornGrandchild()
+
+		results = self.group.terminate(graceful_timeout=2)
+
+		self.assertEqual(results[0].returncode, -signal.SIGTERM)
+		self.assertKilled(grandchild)
+
+	def test_gracefulTerminateKillsGrandchildren(self):
+		proc, grandchild = self.startWithStubbornGrandchild()
+
+		proc.terminate(graceful_timeout=2)
+
+		self.assertEqual(proc.returncode, -signal.SIGTERM)
+		self.assertKilled(grandchild)
+
+	def test_waitForTermination(self):
+		self.group.start(['true'])
+		self.group.start(['exit 2'], shell=True)
+
+		self.assertTrue(self.group.waitForTermination())
+		self.assertEqual([r.returncode for r in self.group.results()], [0, 2])
+		self.assertEqual(self.group.running(), [])
+
+class AsyncProcessTests(ProcessTestCase):
+	def converse(self, proc, word):
+		yield proc.sendLine(word)
+		index = yield proc.expect(['nope', word])
+		self.assertEqual(index, 1)
+		returncode = yield proc.wait()
+		self.assertEqual(returncode, 0)
+
+	def test_concurrentProcesses(self):
+		procs = [lousy.AsyncProcess(['head', '-n', '1']) for i in range(10)]
+
+		start = time.time()
+		lousy.runCoroutines(*[self.converse(proc, 'word%d' % i) for i, proc in enumerate(procs)])
+
+		self.assertLess(time.time() - start, 2)
+		for proc in procs:
+			self.assertFalse(proc.running)
+
+	def test_expectTimeout(self):
+		proc = lousy.AsyncProcess(['cat'])
+
+		def coroutine():
+			index = yield proc.expect(['never'], timeout=0.1)
+			self.assertEqual(index, -1)
+			returncode = yield proc.wait(timeout=0.1)
+			self.assertIsNone(returncode)
+
+		lousy.runCoroutines(coroutine())
+		proc.terminate()
+
+	def test_pause(self):
+		proc = lousy.AsyncProcess(['echo', 'during'])
+
+		def coroutine():
+			start = time.time()
+			result = yield lousy.ProcessOperation(proc, 0.1)
+			self.assertIsNone(result)
+			self.assertGreaterEqual(time.time() - start, 0.1)
+			index = yield proc.expect(['during'], timeout=0)
+			self.assertEqual(index, 0)
+
+		lousy.runCoroutines(coroutine())
+		proc.terminate()
+
+	def test_exceptionPropagates(self):
+		def coroutine():
+			yield
+			raise KeyError('boom')
+
+		self.assertRaises(KeyError, lousy.runCoroutines, coroutine())
+
+	def test_invalidYield(self):
+		def coroutine():
+			yield 'not an operation'
+
+		self.assertRaises(TypeError, lousy.runCoroutines, coroutine())
+
+	@lousy.coroutineTest
+	def test_coroutineTestMethod(self):
+		proc = lousy.AsyncProcess(['cat'], pty='vt100')
+
+		yield proc.sendLine('pty')
+		index = yield proc.expect(['pty'])
+		self.assertEqual(index, 0)
+		proc.terminate()
+
+class ProcessUsageTests(ProcessTestCase):
+	def test_rusageCollected(self):
+		proc = lousy.Process(['sh', '-c', 'i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done'])
+
+		self.assertTrue(proc.waitForTermination(timeout=10))
+		self.assertIsNotNone(proc.usage.rusage)
+		self.assertGreater(proc.usage.cpuTime(), 0)
+		self.assertGreater(proc.usage.maxRss(), 0)
+		self.assertIsNotNone(proc.usage.endTime)
+
+	def test_procSampled(self):
+		proc = lousy.Process(['sleep', '10'])
+		# Give the freshly exec'd child a chance to fault in some pages
+		time.sleep(0.1)
+		proc.usage.sample()
+		proc.terminate()
+
+		self.assertEqual(len(proc.usage.samples), 1)
+		when, rss, cpu, read_bytes, write_bytes = proc.usage.samples[0]
+		self.assertGreater(rss, 0)
+
+	def test_usageAttachedToTiming(self):
+		proc = lousy.Process(['true'])
+		proc.waitForTermination()
+
+		self.assertIn(proc.usage, self.timing.processes)
+
+class OutputLimitsTests(ProcessTestCase):
+	def test_bufferHeadAndTailKept(self):
+		limits = lousy.OutputLimits(maxBuffered=1000, maxLogged=100)
+		proc = lousy.Process(['echo first; head -c 100000 /dev/zero | tr "\\\\0" x; echo; echo last'],
+				shell=True, outputLimits=limits)
+		self.assertTrue(proc.waitForTermination())
+
+		self.assertLessEqual(len(proc.stdout.buffer), 1000 + len(limits.TRUNCATION_MARKER))
+		self.assertTrue(proc.stdout.buffer.startswith('first\n'))
+		self.assertTrue(proc.stdout.buffer.endswith('last\n'))
+		self.assertIn(limits.TRUNCATION_MARKER, proc.stdout.buffer)
+		self.assertEqual(proc.stdout.truncatedBytes + 1000, len('first\n') + 100000 + len('\nlast\n'))
+		self.assertEqual(proc.stdout.loggedBytes, 100)
+		self.assertGreater(proc.stdout.unloggedBytes, 0)
+
+	def test_spillToDisk(self):
+		limits = lousy.OutputLimits(maxBuffered=100, spill=True)
+		proc = lousy.Process(['seq', '1', '1000'], outputLimits=limits)
+		self.assertTrue(proc.waitForTermination())
+		self.assertIsNone(proc.stdout._spillFile)
+
+		try:
+			with open(proc.stdout.spillPath) as f:
+				spilled = f.read()
+		finally:
+			os.unlink(proc.stdout.spillPath)
+
+		expected = ''.join(['%d\n' % i for i in range(1, 1001)])
+		self.assertEqual(len(spilled), proc.stdout.truncatedBytes)
+		self.assertIn(spilled, expected)
+
+	def test_rateLimit(self):
+		limits = lousy.OutputLimits(maxRate=100000, maxLogged=0)
+		proc = lousy.Process(['head', '-c', '300000', '/dev/zero'], outputLimits=limits)
+
+		# One second of burst, a pipe full and then 100000 bytes per second
+		start = time.time()
+		self.assertTrue(proc.waitForTermination())
+		self.assertGreater(time.time() - start, 1.0)
+
+		received = 0
+		while received < 300000 and time.time() - start < 5:
+			received += len(proc.stdout.read())
+		self.assertEqual(received, 300000)
+
+	def test_rateLimitedTailCollected(self):
+		limits = lousy.OutputLimits(maxRate=100000, maxLogged=0)
+		proc = lousy.Process(['head', '-c', '200000', '/dev/zero'], outputLimits=limits)
+		self.assertTrue(proc.waitForTermination())
+
+		# What was still in the pipe when the process exited is read at once
+		self.assertEqual(len(proc.stdout.buffer), 200000)
+
+class CaptureTests(ProcessTestCase):
+	def test_outputView(self):
+		proc = lousy.Process(['seq', '1', '100000'], capture=True)
+		self.assertTrue(proc.waitForTermination())
+
+		expected = ''.join(['%d\n' % i for i in range(1, 100001)])
+		view = proc.outputView()
+		self.assertEqual(len(view), len(expected))
+		self.assertEqual(view[:8], '1\n2\n3\n4\n')
+		self.assertEqual(str(view), expected)
+
+	def test_searchOutput(self):
+		proc = lousy.Process(['seq', '1', '100000'], capture=True)
+		self.assertTrue(proc.waitForTermination())
+
+		match = proc.searchOutput(re.compile('^99999$', re.MULTILINE))
+		self.assertIsNotNone(match)
+		self.assertEqual(proc.outputView()[match.start():match.end()], '99999')
+		self.assertIsNone(proc.searchOutput('100001'))
+
+		self.assertEqual(len(list(proc.findAllOutput(re.compile('^\d*7$', re.MULTILINE)))), 10000)
+
+	def test_stderrStillRead(self):
+		proc = lousy.Process(['sh', '-c', 'echo out; echo err >&2'], capture=True)
+		self.assertEqual(proc.expect(['err'], stream='stderr'), 0)
+		self.assertTrue(proc.waitForTermination())
+		self.assertEqual(str(proc.outputView()), 'out\n')
+
+	def test_noOutput(self):
+		proc = lousy.Process(['true'], capture=True)
+		self.assertTrue(proc.waitForTermination())
+		self.assertEqual(len(proc.outputView()), 0)
+		self.assertIsNone(proc.searchOutput('.'))
+
+	def test_notCaptured(self):
+		proc = lousy.Process(['true'])
+		self.assertTrue(proc.waitForTermination())
+		self.assertRaises(ValueError, proc.outputView)
+		self.assertRaises(ValueError, lousy.Process, ['true'], pty=True, capture=True)
+
+class RegexCacheTests(ProcessTestCase):
+	def test_hitsAndMisses(self):
+		cache = lousy.RegexCache(size=4)
+		first = cache.compile('a+b')
+		self.assertIs(cache.compile('a+b'), first)
+		self.assertEqual((cache.hits, cache.misses), (1, 1))
+		self.assertEqual(cache.hitRate(), 0.5)
+
+	def test_leastRecentlyUsedEvicted(self):
+		cache = lousy.RegexCache(size=2)
+		a = cache.compile('a')
+		cache.compile('b')
+		cache.compile('a')
+		cache.compile('c')
+
+		self.assertIs(cache.compile('a'), a)
+		cache.compile('b')
+		self.assertEqual(cache.misses, 4)
+
+		cache.resize(1)
+		cache.compile('b')
+		self.assertEqual(cache.misses, 4)
+		cache.compile('a')
+		self.assertEqual(cache.misses, 5)
+
+	def test_precompiled(self):
+		cache = lousy.RegexCache()
+		regex = re.compile('x')
+		self.assertIs(cache.compile(regex), regex)
+		self.assertEqual(cache.hits + cache.misses, 0)
+
+	def test_expectPrecompiled(self):
+		proc = lousy.Process(['echo', 'Hello World'])
+		self.assertEqual(proc.expect([re.compile('nope'), re.compile('hello', re.IGNORECASE)]), 1)
+		self.assertTrue(proc.waitForTermination())
+
+class ReadinessProbeTests(ProcessTestCase):
+	def setUp1(self):
+		self.directory = tempfile.mkdtemp(prefix='lousy-test-')
+
+	def tearDown1(self):
+		shutil.rmtree(self.directory)
+
+	def unusedPort(self):
+		sock = socket.socket()
+		sock.bind(('127.0.0.1', 0))
+		port = sock.getsockname()[1]
+		sock.close()
+		return port
+
+	def listener(self, family, address):
+		script = ('import socket, time\n'
+			'time.sleep(0.2)\n'
+			's = socket.socket(%d)\n'
+			's.bind(%r)\n'
+			's.listen(1)\n'
+			'time.sleep(5)\n') % (family, address)
+		return lousy.Process([sys.executable, '-c', script])
+
+	def test_tcp(self):
+		port = self.unusedPort()
+		proc = self.listener(socket.AF_INET, ('127.0.0.1', port))
+
+		ready = proc.waitUntilReady([lousy.TcpProbe(port)])
+		self.assertIsNotNone(ready)
+		self.assertGreaterEqual(ready, 0.2)
+		self.assertEqual(proc.usage.readyTime, ready)
+		proc.terminate()
+
+	def test_unix(self):
+		path = os.path.join(self.directory, 'socket')
+		proc = self.listener(socket.AF_UNIX, path)
+
+		self.assertGreaterEqual(proc.waitUntilReady([lousy.UnixProbe(path)]), 0.2)
+		proc.terminate()
+
+	def test_file(self):
+		path = os.path.join(self.directory, 'pidfile')
+		proc = lousy.Process(['sh', '-c', 'sleep 0.2; touch %s; exec sleep 5' % path])
+
+		self.assertGreaterEqual(proc.waitUntilReady([lousy.FileProbe(path)]), 0.2)
+		proc.terminate()
+
+	def test_output(self):
+		proc = lousy.Process(['sh', '-c', 'echo starting; sleep 0.1; echo listening on 99; exec sleep 5'])
+
+		self.assertIsNotNone(proc.waitUntilReady([lousy.OutputProbe('listening on \d+')]))
+		self.assertEqual(proc.readLine(), 'starting')
+		self.assertEqual(proc.readLine(), 'listening on 99')
+		proc.terminate()
+
+	def test_allProbes(self):
+		path = os.path.join(self.directory, 'pidfile')
+		proc = lousy.Process(['sh', '-c', 'touch %s; sleep 0.2; echo up; exec sleep 5' % path])
+
+		probes = [lousy.FileProbe(path), lousy.OutputProbe('up')]
+		self.assertGreaterEqual(proc.waitUntilReady(probes), 0.2)
+		proc.terminate()
+
+	def test_timeout(self):
+		proc = lousy.Process(['sleep', '5'])
+
+		start = time.time()
+		self.assertIsNone(proc.waitUntilReady([lousy.FileProbe(os.path.join(self.directory, 'never'))],
+				timeout=0.2))
+		self.assertLess(time.time() - start, 1)
+		self.assertIsNone(proc.usage.readyTime)
+		proc.terminate()
+
+	def test_exitBeforeReady(self):
+		proc = lousy.Process(['true'])
+
+		start = time.time()
+		self.assertIsNone(proc.waitUntilReady([lousy.TcpProbe(self.unusedPort())]))
+		self.assertLess(time.time() - start, 1)
@@ -1,15 +1,23 @@
 # Tests of the Stub Protocol
 
 import lousy
+import os
 import socket
 import struct
+import sys
+import tempfile
 import threading
+import time
+
+def frame(msg):
+	'''Return the message with its header as sent over the socket
+	'''
+	return struct.pack(lousy.MSG_HEADER_FMT, len(msg)) + msg
 
 def send(sock, msg):
 	'''Send the given message to the stub as the far end
 	'''
-	buf = struct.pack(lousy.MSG_HEADER_FMT, len(msg))
-	return sock.send(buf + msg)
+	return sock.send(frame(msg))
 
 class StubTestCase(lousy.TestCase):
 	pass
@@ -97,6 +105,134 @@ class StubCentralTests(StubTestCase):
 
 		self.assertIsNone(stub)
 
+	def test_waitForStubBackToBack(self):
+		first = lousy.StubClient('SimpleStub', 'first')
+		second = lousy.StubClient('SimpleStub', 'second')
+
+		ids = set([lousy.stubs.waitForStub().id, lousy.stubs.waitForStub().id])
+		self.assertEqual(ids, set(['first', 'second']))
+		self.assertIsNone(lousy.stubs.waitForStub(timeout=0.1))
+
+		first.close()
+		second.close()
+
+	def test_waitForStubWithId(self):
+		clients = [lousy.StubClient('SimpleStub', 'client%d' % i) for i in range(200)]
+
+		for i in reversed(range(len(clients))):
+			stub = lousy.stubs.waitForStub(id='client%d' % i)
+			self.assertIsNotNone(stub)
+			self.assertEqual(stub.id, 'client%d' % i)
+			self.assertIs(lousy.stubs.stub('client%d' % i), stub)
+
+		self.assertIsNone(lousy.stubs.waitForStub(timeout=0.1))
+
+		for client in clients:
+			client.close()
+
+	def test_waitForStubWithIdAndType(self):
+		client = lousy.StubClient('SimpleStub', 'typed')
+
+		self.assertIsNone(lousy.stubs.waitForStub('NotSoSimpleStub', id='typed', timeout=0.1))
+		self.assertIsNotNone(lousy.stubs.waitForStub('SimpleStub', id='typed'))
+
+		client.close()
+
+	def test_waitForStubBeforeConnect(self):
+		found = []
+		waiter = threading.Thread(target=lambda: found.append(lousy.stubs.waitForStub(id='late')))
+		waiter.start()
+
+		time.sleep(0.1)
+		client = lousy.StubClient('SimpleStub', 'late')
+		waiter.join()
+
+		self.assertEqual(found[0].id, 'late')
+		client.close()
+
+	def test_reset(self):
+		client = lousy.StubClient('SimpleStub', 'forgotten')
+		self.assertIsNotNone(lousy.stubs.waitForStub(id='forgotten'))
+
+		lousy.stubs.reset()
+
+		self.assertIsNone(lousy.stubs.stub('forgotten'))
+		client.close()
+
+	def test_waitAcrossReset(self):
+		found = []
+		waiter = threading.Thread(target=lambda: found.append(lousy.stubs.waitForStub(id='after')))
+		waiter.start()
+
+		time.sleep(0.1)
+		lousy.stubs.reset()
+		client = lousy.StubClient('SimpleStub', 'after')
+		waiter.join()
+
+		self.assertEqual(found[0].id, 'after')
+		client.close()
+
+	def test_waitersForgotten(self):
+		for i in range(10):
+			self.assertIsNone(lousy.stubs.waitForStub(id='missing%d' % i, timeout=0.01))
+		self.assertEqual(lousy.stubs._waiters, {})
+
+	def test_startedOnDemand(self):
+		central = type(lousy.stubs)()
+		self.assertFalse(central.is_alive())
+
+		# Bound and listening as soon as the port is known
+		sock = socket.create_connection(('localhost', central.port()))
+		send(sock, 'SimpleStub,demand')
+		self.assertIsNotNone(central.waitForStub(id='demand'))
+		sock.close()
+
+		start = time.time()
+		central.stop()
+		self.assertFalse(central.is_alive())
+		self.assertLess(time.time() - start, 1)
+
+	def test_localOnlyDoesNotBindTcp(self):
+		central = type(lousy.stubs)()
+		client = lousy.StubClient('SimpleStub', 'local', path=central.path())
+		self.assertIsNotNone(central.waitForStub(id='local'))
+		self.assertIsNone(central._listener)
+
+		client.close()
+		central.stop()
+
+	def test_stopUnused(self):
+		central = type(lousy.stubs)()
+		central.stop()
+		self.assertFalse(central.is_alive())
+
+	def test_manyConnections(self):
+		stubs = []
+		created = threading.Condition()
+		def callback(stub, type):
+			with created:
+				stubs.append(stub)
+				created.notify()
+
+		lousy.stubs.add_class('ManyStub', lousy.SimpleStub, callback)
+
+		port = lousy.stubs.port()
+		socks = []
+		for i in range(200):
+			sock = socket.create_connection(('localhost', port))
+			sock.sendall(frame('ManyStub,many%d' % i) + frame('from %d' % i))
+			socks.append(sock)
+
+		with created:
+			while len(stubs) < len(socks):
+				created.wait(5)
+
+		received = set([stub.read() for stub in stubs])
+		self.assertEqual(received, set(['from %d' % i for i in range(len(socks))]))
+
+		for sock in socks:
+			sock.close()
+
 class SimpleStubTests(StubTestCase):
 	def setUp1(self):
 		port = lousy.stubs.port()
@@ -136,3 +272,456 @@ class SimpleStubTests(StubTestCase):
 
 		t = self.recv()
 		self.assertEqual(s, t)
+
+	def test_severalMessagesInOneSend(self):
+		messages = ['first', 'second', '', 'fourth']
+		self.sock.sendall(''.join([frame(msg) for msg in messages]))
+
+		for msg in messages:
+			self.assertEqual(self.stub.read(), msg)
+
+	def test_readMany(self):
+		messages = ['message %d' % i for i in range(10)]
+		self.sock.sendall(''.join([frame(msg) for msg in messages]))
+
+		received = []
+		while len(received) < len(messages):
+			batch = self.stub.readMany(3)
+			self.assertTrue(0 < len(batch) <= 3)
+			received.extend(batch)
+		self.assertEqual(received, messages)
+
+	def test_readAll(self):
+		messages = ['message %d' % i for i in range(10)]
+		self.sock.sendall(''.join([frame(msg) for msg in messages]))
+
+		received = []
+		while len(received) < len(messages):
+			batch = self.stub.readAll()
+			self.assertNotEqual(batch, [])
+			received.extend(batch)
+		self.assertEqual(received, messages)
+		self.assertEqual(self.stub.readAll(timeout=0), [])
+
+	def test_readReady(self):
+		self.assertFalse(self.stub.read_ready.is_set())
+		self.assertFalse(self.stub.read_ready.wait(0.01))
+
+		self.send('message')
+		self.assertTrue(self.stub.read_ready.wait(5))
+		self.assertTrue(self.stub.read_ready.is_set())
+
+		self.stub.read()
+		self.assertFalse(self.stub.read_ready.is_set())
+
+	def test_readUntil(self):
+		self.send('first')
+		self.send('second')
+		self.send('stop')
+		self.send('after')
+
+		self.assertEqual(self.stub.readUntil(lambda msg: msg == 'stop'),
+				['first', 'second', 'stop'])
+		self.assertEqual(self.stub.read(), 'after')
+
+	def test_readUntilTimeout(self):
+		self.send('first')
+
+		self.assertEqual(self.stub.readUntil(lambda msg: False, timeout=0.2), [])
+		self.assertEqual(self.stub.read(), 'first')
+
+	def test_largeMessage(self):
+		s = ''.join([chr(i % 256) for i in range(256)]) * 8192
+		self.sock.sendall(frame(s))
+
+		self.assertEqual(self.stub.read(), s)
+
+	def test_messageWithRegistration(self):
+		port = lousy.stubs.port()
+		sock = socket.create_connection(('localhost', port))
+		sock.sendall(frame('SimpleStub,id2') + frame('early'))
+
+		stub = lousy.stubs.waitForStub()
+		self.assertEqual(stub.read(), 'early')
+		sock.close()
+
+	def test_writeManyMessages(self):
+		messages = ['message %d' % i for i in range(1000)]
+		for msg in messages:
+			self.stub.write(msg)
+
+		for msg in messages:
+			self.assertEqual(lousy._readStubMessage(self.sock), msg)
+
+	def test_writeLargeMessages(self):
+		big = ''.join([chr(i % 256) for i in range(256)]) * 8192
+		self.stub.write('small')
+		self.stub.write(big)
+		self.stub.write('after')
+
+		self.assertEqual(lousy._readStubMessage(self.sock), 'small')
+		self.assertEqual(lousy._readStubMessage(self.sock), big)
+		self.assertEqual(lousy._readStubMessage(self.sock), 'after')
+
+		self.stub.flush()
+		self.assertEqual(len(self.stub.out_buf), 0)
+
+	def test_disconnect(self):
+		self.stub.write('goodbye')
+		self.stub.disconnect()
+
+		self.assertEqual(lousy._readStubMessage(self.sock), 'goodbye')
+		self.assertEqual(self.sock.recv(10), '')
+
+class FrameDecoderTests(StubTestCase):
+	def setUp1(self):
+		self.decoder = lousy.FrameDecoder()
+
+	def test_oneByteAtATime(self):
+		data = frame('hello') + frame('world')
+		messages = []
+		for c in data:
+			messages.extend(self.decoder.feed(c))
+		self.assertEqual(messages, ['hello', 'world'])
+
+	def test_manyFrames(self):
+		messages = ['message %d' % i for i in range(100)]
+		self.assertEqual(self.decoder.feed(''.join([frame(msg) for msg in messages])), messages)
+
+	def test_frameAcrossFeeds(self):
+		data = frame('x' * 100000)
+		self.assertEqual(self.decoder.feed(data[:10]), [])
+		self.assertEqual(self.decoder.feed(data[10:50000]), [])
+		self.assertEqual(self.decoder.feed(data[50000:] + frame('next')), ['x' * 100000, 'next'])
+
+	def test_emptyMessage(self):
+		self.assertEqual(self.decoder.feed(frame('') + frame('')), ['', ''])
+
+class StubClientTests(StubTestCase):
+	def test_roundTrip(self):
+		client = lousy.StubClient('SimpleStub', 'client1')
+		stub = lousy.stubs.waitForStub()
+
+		client.send('ping')
+		self.assertEqual(stub.read(), 'ping')
+
+		stub.write('pong')
+		self.assertEqual(client.recv(), 'pong')
+
+		stub.disconnect()
+		self.assertIsNone(client.recv())
+		client.close()
+
+	def roundTrip(self, client, id):
+		stub = lousy.stubs.waitForStub(id=id)
+		self.assertIsNotNone(stub)
+
+		client.send('ping')
+		self.assertEqual(stub.read(), 'ping')
+		stub.write('pong')
+		self.assertEqual(client.recv(), 'pong')
+		client.close()
+
+	def test_unixDomainSocket(self):
+		client = lousy.StubClient('SimpleStub', 'unix', path=lousy.stubs.path())
+		self.roundTrip(client, 'unix')
+
+	def test_socketpair(self):
+		client = lousy.StubClient('SimpleStub', 'pair', sock=lousy.stubs.socketpair())
+		self.roundTrip(client, 'pair')
+
+class ReactorTests(StubTestCase):
+	class Handler(object):
+		def fileno(self):
+			return 0
+
+	def test_queuedCallsRunOnClose(self):
+		# The polling thread is alive but never polls, as if it was
+		# stopped just after the call was queued
+		stopped = threading.Event()
+		thread = threading.Thread(target=stopped.wait)
+		thread.start()
+		reactor = lousy.Reactor(thread)
+
+		caller = threading.Thread(target=reactor.unregister, args=(self.Handler(),))
+		caller.start()
+		while len(reactor._calls) == 0:
+			time.sleep(0.01)
+
+		reactor.close()
+		caller.join(5)
+		self.assertFalse(caller.is_alive())
+		stopped.set()
+		thread.join()
+
+class ProcessStubTests(StubTestCase):
+	# The child connects with StubClient from its environment and echoes a message
+	script = ('import lousy\n'
+		'client = lousy.StubClient("SimpleStub", "child")\n'
+		'client.send(client.recv())\n')
+
+	def echo(self, stub, **kwargs):
+		proc = lousy.Process([sys.executable, '-c', self.script], stub=stub, **kwargs)
+
+		stub = lousy.stubs.waitForStub(id='child')
+		self.assertIsNotNone(stub)
+		stub.write('echo')
+		self.assertEqual(stub.read(), 'echo')
+		self.assertTrue(proc.waitForTermination())
+		self.assertEqual(proc.process.returncode, 0)
+
+	def test_environment(self):
+		proc = lousy.Process(['sh', '-c', 'echo $%s $%s $%s' %
+			(lousy.STUB_PATH_ENV, lousy.STUB_PORT_ENV, lousy.STUB_FD_ENV)], stub=True)
+		proc.waitForTermination()
+		self.assertEqual(proc.readLine(), lousy.stubs.path())
+
+	def test_environmentTcp(self):
+		proc = lousy.Process(['sh', '-c', 'echo $%s $%s' %
+			(lousy.STUB_PATH_ENV, lousy.STUB_PORT_ENV)], stub='tcp')
+		proc.waitForTermination()
+		self.assertEqual(proc.readLine(), '%s %d' % (lousy.stubs.path(), lousy.stubs.port()))
+
+	def test_socketpairFdConsumed(self):
+		script = ('import lousy, os\n'
+			'client = lousy.StubClient("SimpleStub", "child")\n'
+			'client.send(str(lousy.STUB_FD_ENV in os.environ))\n')
+		proc = lousy.Process([sys.executable, '-c', script], stub='pair')
+
+		stub = lousy.stubs.waitForStub(id='child')
+		self.assertIsNotNone(stub)
+		self.assertEqual(stub.read(), 'False')
+		self.assertTrue(proc.waitForTermination())
+
+	def test_unixDomainSocket(self):
+		self.echo(True)
+
+	def test_socketpair(self):
+		self.echo('pair')
+
+	def test_socketpairClosedFds(self):
+		self.echo('pair', close_fds=True)
+
+class RpcStubTests(StubTestCase):
+	def setUp1(self):
+		lousy.stubs.add_class('RpcStub', lousy.RpcStub)
+		self.client = lousy.StubClient('RpcStub', 'rpc1')
+		self.stub = lousy.stubs.waitForStub('RpcStub')
+
+	def tearDown1(self):
+		self.client.close()
+
+	def clientCall(self, id, method, *args):
+		self.client.send(lousy.encodeRpcMessage(lousy.RPC_REQUEST, id, method, list(args)))
+
+	def clientReceive(self):
+		return lousy.decodeRpcMessage(self.client.recv())
+
+	def test_encoding(self):
+		values = [None, True, False, 0, -5, 2 ** 40, 1.5, '', 'bytes\x00', u'\xe9t\xe9',
+				[1, [2, 'three']], {'a': 1, 2: [None]}]
+		for value in values:
+			encoded = lousy.encodeRpcValue(value)
+			self.assertEqual(lousy.decodeRpcValue(encoded), (value, len(encoded)))
+
+		self.assertRaises(TypeError, lousy.encodeRpcValue, object())
+
+	def test_callsAnsweredOutOfOrder(self):
+		first = self.stub.call('add', 1, 2)
+		second = self.stub.call('name')
+
+		kind, first_id, values = self.clientReceive()
+		self.assertEqual((kind, values), (lousy.RPC_REQUEST, ['add', [1, 2]]))
+		kind, second_id, values = self.clientReceive()
+		self.assertEqual((kind, values), (lousy.RPC_REQUEST, ['name', []]))
+
+		self.client.send(lousy.encodeRpcMessage(lousy.RPC_RESPONSE, second_id, 'far end'))
+		self.assertEqual(second.result(), 'far end')
+		self.assertFalse(first.done())
+
+		self.client.send(lousy.encodeRpcMessage(lousy.RPC_RESPONSE, first_id, 3))
+		self.assertEqual(first.result(), 3)
+
+	def test_errorResponse(self):
+		future = self.stub.call('broken')
+		kind, id, values = self.clientReceive()
+		self.client.send(lousy.encodeRpcMessage(lousy.RPC_ERROR, id, 'it broke'))
+
+		self.assertRaises(lousy.RpcError, future.result)
+
+	def test_noResponse(self):
+		future = self.stub.call('ignored')
+		self.assertRaises(lousy.RpcError, future.result, 0.1)
+
+	def test_disconnectFailsOutstandingCalls(self):
+		future = self.stub.call('ignored')
+		self.client.close()
+
+		start = time.time()
+		self.assertRaises(lousy.RpcError, future.result)
+		self.assertLess(time.time() - start, 1)
+
+	def test_incomingCalls(self):
+		self.clientCall(7, 'first', 'a')
+		self.clientCall(8, 'second', 'b', 'c')
+
+		first = self.stub.nextCall()
+		second = self.stub.nextCall()
+		self.assertEqual((first.method, first.args), ('first', ['a']))
+		self.assertEqual((second.method, second.args), ('second', ['b', 'c']))
+
+		second.reply('two')
+		first.fail('one failed')
+		self.assertEqual(self.clientReceive(), (lousy.RPC_RESPONSE, 8, ['two']))
+		self.assertEqual(self.clientReceive(), (lousy.RPC_ERROR, 7, ['one failed']))
+
+		self.assertIsNone(self.stub.nextCall(timeout=0.1))
+
+	def test_handler(self):
+		self.stub.handle('add', lambda a, b: a + b)
+
+		self.clientCall(1, 'add', 2, 3)
+		self.assertEqual(self.clientReceive(), (lousy.RPC_RESPONSE, 1, [5]))
+
+		self.clientCall(2, 'add', 2, 'three')
+		kind, id, values = self.clientReceive()
+		self.assertEqual((kind, id), (lousy.RPC_ERROR, 2))
+		self.assertIn('TypeError', values[0])
+
+class BulkStubTests(StubTestCase):
+	def setUp1(self):
+		lousy.stubs.add_class('BulkStub', lousy.BulkStub)
+		self.client = lousy.BulkStubClient('BulkStub', 'bulk1', ringSize=1024 * 1024,
+				path=lousy.stubs.path())
+		self.stub = lousy.stubs.waitForStub(id='bulk1')
+
+	def tearDown1(self):
+		self.client.close()
+
+	def payload(self, size, seed=0):
+		return ''.join([chr((i + seed) % 251) for i in range(251)]) * (size // 251)
+
+	def test_smallPayloadsInline(self):
+		self.client.send('ping')
+		payload = self.stub.readPayload()
+		self.assertIsNone(payload.position)
+		self.assertEqual(payload.tobytes(), 'ping')
+
+		self.stub.write('pong')
+		self.assertEqual(self.client.recv(), 'pong')
+
+	def test_largePayloads(self):
+		big = self.payload(300000)
+
+		self.client.send(big)
+		self.assertEqual(self.stub.read(), big)
+
+		self.stub.write(big)
+		payload = self.client.recvPayload()
+		self.assertIsNotNone(payload.position)
+		self.assertEqual(len(payload), len(big))
+		self.assertEqual(payload.view()[:251], big[:251])
+		self.assertEqual(payload.tobytes(), big)
+		payload.release()
+		self.assertRaises(ValueError, payload.view)
+
+	def test_ringReused(self):
+		# Many times the ring size passes through it as space is freed
+		for i in range(20):
+			big = self.payload(300000, i)
+			self.client.send(big)
+			payload = self.stub.readPayload()
+			self.assertIsNotNone(payload.position)
+			self.assertEqual(payload.tobytes(), big)
+			payload.release()
+
+			# The freed space is known to the client once it reads the reply
+			self.stub.write('ack')
+			self.assertEqual(self.client.recv(), 'ack')
+
+	def test_releasedOutOfOrder(self):
+		payloads = [self.payload(300000, i) for i in range(3)]
+		for data in payloads:
+			self.client.send(data)
+
+		received = [self.stub.readPayload() for data in payloads]
+		for payload, data in reversed(zip(received, payloads)):
+			self.assertEqual(payload.tobytes(), data)
+			payload.release()
+
+		self.stub.write('ack')
+		self.assertEqual(self.client.recv(), 'ack')
+		self.client.send(payloads[0])
+		self.assertIsNotNone(self.stub.readPayload().position)
+
+	def test_fullRingSentInline(self):
+		payloads = [self.payload(400000, i) for i in range(3)]
+		for data in payloads:
+			self.client.send(data)
+
+		received = [self.stub.readPayload() for data in payloads]
+		self.assertIsNone(received[2].position)
+		self.assertEqual([payload.tobytes() for payload in received], payloads)
+
+class BulkProtocolErrorTests(StubTestCase):
+	def setUp1(self):
+		lousy.stubs.add_class('BulkStub', lousy.BulkStub)
+		self.client = lousy.StubClient('BulkStub', 'bad', path=lousy.stubs.path())
+		self.stub = lousy.stubs.waitForStub(id='bad')
+
+		fd, self.victim = tempfile.mkstemp()
+		os.close(fd)
+
+	def tearDown1(self):
+		self.client.close()
+		if os.path.exists(self.victim):
+			os.unlink(self.victim)
+
+	def ring(self, size, name):
+		return lousy.BULK_RING + struct.pack(lousy.BULK_RING_FMT, size) + name
+
+	def assertClosed(self):
+		self.assertIsNone(self.client.recv())
+
+	def test_ringNameOutsideShm(self):
+		self.client.send(self.ring(4096, '/../..' + self.victim))
+		self.assertClosed()
+		self.assertTrue(os.path.exists(self.victim))
+
+	def test_ringNameSymlink(self):
+		link = '%s/lousy-bulk-%d-999999' % (lousy.SHM_DIR, os.getpid())
+		os.symlink(self.victim, link)
+		try:
+			self.client.send(self.ring(4096, link[len(lousy.SHM_DIR):]))
+			self.assertClosed()
+		finally:
+			os.unlink(link)
+		self.assertTrue(os.path.exists(self.victim))
+
+	def test_ringLargerThanObject(self):
+		ring = lousy.BulkRing(4096)
+		self.client.send(self.ring(8192, ring.name))
+		self.assertClosed()
+		ring.close()
+
+	def test_payloadBeforeRing(self):
+		self.client.send(lousy.BULK_PAYLOAD + struct.pack(lousy.BULK_PAYLOAD_FMT, 0, 10))
+		self.assertClosed()
+
+	def test_payloadOutsideRing(self):
+		ring = lousy.BulkRing(4096)
+		self.client.send(self.ring(4096, ring.name))
+		self.client.send(lousy.BULK_PAYLOAD + struct.pack(lousy.BULK_PAYLOAD_FMT, 4000, 1000))
+		self.assertClosed()
+		ring.close()
+
+class BenchTests(StubTestCase):
+	def test_benchStubs(self):
+		script = os.path.splitext(lousy.__file__)[0] + '.py'
+		proc = lousy.Process([sys.executable, script, 'bench', 'stubs', '-n', '1', '-m', '5'])
+
+		self.assertTrue(proc.waitForTermination(timeout=30))
+		self.assertEqual(proc.returncode, 0)
+		output = proc.stdout.read()
+		self.assertIn('BenchSimple: 1 clients, 5 round trips', output)
+		self.assertIn('BenchEcho: 1 clients, 5 round trips', output)
@@ -1513,6 +1513,113 @@ class VttyTests(TerminalTestCase):
 		t = self.vtty.string(0, 79, 30)
 		self.assertEqual(t, self.vtty.cell(0, 79).char)
 
+class VttyChangeTests(TerminalTestCase):
+	'''Test the tracking of which rows of the screen have changed'''
+	def setUp1(self):
+		self.vtty = lousy.Vtty('vt100')
+
+	def tearDown1(self):
+		pass
+
+	def changedRows(self, since):
+		return [row for row in range(self.vtty.rows()) if self.vtty.rowChanged(row, since)]
+
+	def test_row(self):
+		self.vtty.append('ab\tc')
+		self.assertEqual(self.vtty.row(0), 'ab      c' + ' ' * 71)
+		self.assertEqual(self.vtty.row(0, 1, 3), 'b  ')
+
+	def test_writeChangesCursorRow(self):
+		self.vtty.append('\033[5;1H')
+		since = self.vtty.changes()
+		self.vtty.append('hello')
+		self.assertEqual(self.changedRows(since), [4])
+
+		since = self.vtty.changes()
+		self.assertEqual(self.changedRows(since), [])
+
+	def test_clearScreenChangesAll(self):
+		since = self.vtty.changes()
+		self.vtty.append('\033[2J')
+		self.assertEqual(len(self.changedRows(since)), self.vtty.rows())
+
+	def test_scrollChangesAll(self):
+		self.vtty.append('\033[24;1H')
+		since = self.vtty.changes()
+		self.vtty.append('\n')
+		self.assertEqual(len(self.changedRows(since)), self.vtty.rows())
+
+class LazyVttyTests(TerminalTestCase):
+	'''Test the Vtty deferring interpretation until the screen is examined'''
+	def setUp1(self):
+		self.vtty = lousy.Vtty('vt100', mode='lazy')
+		self.vty = self.vtty
+
+	def tearDown1(self):
+		pass
+
+	def test_deferred(self):
+		self.vtty.append('ab')
+		self.vtty.append('\033[3;5Hc')
+		self.assertEqual(self.vtty._emulation.current_col, 0)
+
+		self.assertEqual(self.vtty.cursorPosition(), (2, 5))
+		self.assertCellChar(0, 1, 'b')
+		self.assertCellChar(2, 4, 'c')
+
+	def test_escapeSplitAcrossChunks(self):
+		self.vtty.append('\033[')
+		self.vtty.append('2;2Hx')
+		self.assertEqual(self.vtty.string(1, 1, 1), 'x')
+
+	def test_snapshotMatchesImmediate(self):
+		immediate = lousy.Vtty('vt100')
+		for chunk in ['hello\r\n', '\033[1mbold\033[0m', '\033[10;10Hthere']:
+			immediate.append(chunk)
+			self.vtty.append(chunk)
+		self.assertTrue(self.vtty.snapShotScreen()._framebuffer == immediate.snapShotScreen()._framebuffer)
+
+	def test_closeLeavesOutputDeferred(self):
+		self.vtty.append('\033[3;5Hc')
+		self.vtty.close()
+		self.assertEqual(self.vtty._emulation.current_col, 0)
+
+		self.assertCellChar(2, 4, 'c')
+
+	def test_invalidMode(self):
+		self.assertRaises(ValueError, lousy.Vtty, 'vt100', 'sometimes')
+
+class ThreadVttyTests(TerminalTestCase):
+	'''Test the Vtty interpreting on a worker thread'''
+	def setUp1(self):
+		self.vtty = lousy.Vtty('vt100', mode='thread', queueSize=2)
+		self.vty = self.vtty
+
+	def tearDown1(self):
+		self.vtty.close()
+
+	def test_sync(self):
+		for i in range(20):
+			self.vtty.append('\033[%d;1Hrow %d' % (i + 1, i))
+
+		self.vtty.sync()
+		self.assertEqual(self.vtty._queue.unfinished_tasks, 0)
+		self.assertEqual(self.vtty._emulation.current_row, 19)
+
+	def test_accessorsSync(self):
+		self.vtty.append('\033[3;5Hc')
+		self.assertEqual(self.vtty.cursorPosition(), (2, 5))
+		self.assertCellChar(2, 4, 'c')
+
+	def test_close(self):
+		self.vtty.append('a')
+		self.vtty.close()
+		self.assertFalse(self.vtty._worker.is_alive())
+		self.assertCellChar(0, 0, 'a')
+
+		self.vtty.append('b')
+		self.assertCellChar(0, 1, 'b')
+
 class TypicalTtyTests(TerminalTestCase):
 	'''Test the TypicalTty class'''
 	def setUp1(self):